@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+##########################################################################
+# This is the benchmarking script for the MonsterBorg self-driving code #
+# It runs the processing on synthetic frames, no hardware is needed     #
+##########################################################################
+
+# Load all the library functions we want
+import argparse
+import json
+import time
+import cv2
+import numpy
+import Settings
+import ImageProcessor
+import FrameSource
+import PipelineStats
+import ThunderBorg
+import ThunderBorgSim
+
+# Image sizes, erosion sizes, and thread counts tried by the stage benchmarks
+sweepSizes = [(80, 60), (160, 120), (320, 240)]
+sweepErodeSizes = [1, 3, 5, 7]
+sweepThreads = [1, 2, 4]
+
+# Simulated IC bus conditions tried by the driver benchmark, (name, time per byte, read error rate)
+driverBuses = [('noDelay', 0.0, 0.0),
+               ('100kHz', ThunderBorgSim.defaultByteTime, 0.0),
+               ('100kHzErrors', ThunderBorgSim.defaultByteTime, 0.05)]
+
+# Function used in place of the MonsterBorg motors
+def NoMotors(driveLeft, driveRight):
+    pass
+
+# Run the full capture, processing, and control pipeline for a number of frames
+# Returns the number of frames per second processed
+def RunPipeline(useProcesses, frameCount):
+    # Reset the shared values
+    Settings.running = True
+    Settings.frameCounter = 0
+    Settings.displayData = None
+    Settings.MonsterMotors = NoMotors
+    Settings.capture = FrameSource.SyntheticSource(False)
+    # Start the processing
+    Settings.pipelineStats = PipelineStats.PipelineStats()
+    if useProcesses:
+        Settings.framePool = ImageProcessor.FramePool(Settings.processingThreads, True)
+        allProcessors = [ImageProcessor.ProcessWorker(i+1) for i in range(Settings.processingThreads)]
+    else:
+        Settings.framePool = ImageProcessor.FramePool(Settings.processingThreads)
+        allProcessors = [ImageProcessor.StreamProcessor(i+1) for i in range(Settings.processingThreads)]
+    Settings.processorPool = ImageProcessor.ProcessorPool(allProcessors)
+    Settings.motorDispatcher = ImageProcessor.MotorDispatcher()
+    Settings.controller = ImageProcessor.ControlLoop()
+    # Only time the processing, not the worker processes starting up
+    for event in [processor.ready for processor in allProcessors] + [Settings.motorDispatcher.ready, Settings.controller.ready]:
+        event.wait(Settings.startupTimeout)
+    startTime = time.time()
+    captureThread = ImageProcessor.ImageCapture()
+    while Settings.frameCounter < frameCount:
+        time.sleep(0.01)
+    # Stop everything, waiting for the frames in progress to finish
+    Settings.running = False
+    Settings.processorPool.Close()
+    captureThread.join()
+    for processor in allProcessors:
+        processor.terminated = True
+        processor.event.set()
+        processor.join()
+    endTime = time.time()
+    Settings.controller.terminated = True
+    Settings.controller.event.set()
+    Settings.controller.join()
+    Settings.motorDispatcher.terminated = True
+    Settings.motorDispatcher.event.set()
+    Settings.motorDispatcher.join()
+    Settings.capture.release()
+    return Settings.frameCounter / (endTime - startTime)
+
+# Compare processing threads against processing processes
+def ComparePoolModes(frameCount):
+    results = {}
+    for useProcesses in (False, True):
+        results[useProcesses] = RunPipeline(useProcesses, frameCount)
+    print
+    print 'Processing %d frames with %d workers:' % (frameCount, Settings.processingThreads)
+    print '    Threads   : %7.1f FPS' % (results[False])
+    print '    Processes : %7.1f FPS (%.2fx)' % (results[True], results[True] / results[False])
+
+# Time a single stage, function is called repeats times working through the inputs in turn
+# Returns the throughput and the latency percentiles in microseconds
+def TimeStage(function, inputs, repeats):
+    times = numpy.empty(repeats)
+    for i in range(repeats):
+        value = inputs[i % len(inputs)]
+        startTime = time.time()
+        function(value)
+        times[i] = time.time() - startTime
+    times *= 1000000.0
+    p50, p95, p99 = numpy.percentile(times, (50, 95, 99))
+    return {'perSecond': 1000000.0 / times.mean(), 'meanUs': times.mean(),
+            'p50Us': p50, 'p95Us': p95, 'p99Us': p99}
+
+# Change the scaled image size, keeping the target rows in the same place on the image
+def SetScaledSize(width, height):
+    scale = float(height) / Settings.scaledHeight
+    Settings.targetY1 = int(Settings.targetY1 * scale)
+    Settings.targetY2 = int(Settings.targetY2 * scale)
+    if Settings.targetRows:
+        Settings.targetRows = [int(Y * scale) for Y in Settings.targetRows]
+    Settings.scaledWidth = width
+    Settings.scaledHeight = height
+
+# Time each stage of the processing and control with the current settings
+# Each stage is fed the output of the stage before it, so they all see realistic images
+def BenchmarkStages(frames, repeats):
+    finder = ImageProcessor.LineFinder('Benchmark', False)
+    stages = {}
+    scaledSize = (Settings.scaledWidth, Settings.scaledHeight)
+    # Image preparation, flipResize is the single pass used in place of flip then resize
+    stages['flip'] = TimeStage(lambda frame: cv2.flip(frame, -1), frames, repeats)
+    stages['resize'] = TimeStage(lambda frame: cv2.resize(frame, scaledSize, interpolation = cv2.INTER_NEAREST),
+                                 frames, repeats)
+    pixelMap = finder.BuildPixelMap(range(Settings.scaledHeight))
+    stages['flipResize'] = TimeStage(lambda frame: cv2.remap(frame, pixelMap, None, cv2.INTER_NEAREST), frames, repeats)
+    if finder.bandProcessing:
+        stages['bands'] = TimeStage(finder.GrabBands, frames, repeats)
+    images = [cv2.remap(frame, pixelMap, None, cv2.INTER_NEAREST) for frame in frames]
+    # Line finding
+    stages['colour'] = TimeStage(ImageProcessor.colourClassifier.Classify, images, repeats)
+    masks = [ImageProcessor.colourClassifier.Classify(image) for image in images]
+    if Settings.erodeSize > 1:
+        erodeKernel = numpy.ones((Settings.erodeSize, Settings.erodeSize), numpy.uint8)
+        stages['erode'] = TimeStage(lambda mask: cv2.erode(mask, erodeKernel), masks, repeats)
+        masks = [cv2.erode(mask, erodeKernel) for mask in masks]
+    def SweepLine(mask):
+        sectionRows, sizes, centres = finder.SweepLines(mask, finder.targetRows)
+        return finder.LargestSections(len(finder.targetRows), sectionRows, sizes, centres)
+    stages['sweepLine'] = TimeStage(SweepLine, masks, repeats)
+    sweeps = [finder.SweepLines(mask, finder.targetRows) for mask in masks]
+    if finder.fitRows:
+        def OffsetMath((mask, (sectionRows, sizes, centres))):
+            largestCentres, largestSizes = finder.LargestSections(len(finder.targetRows), sectionRows, sizes, centres)
+            return finder.FitRows(None, mask, sectionRows, sizes, largestCentres, largestSizes)
+        stages['offsetMath'] = TimeStage(OffsetMath, zip(masks, sweeps), repeats)
+    else:
+        points = []
+        for sectionRows, sizes, centres in sweeps:
+            largestCentres, largestSizes = finder.LargestSections(2, sectionRows, sizes, centres)
+            points.append([int(X) if X >= 0 else None for X in largestCentres])
+        stages['offsetMath'] = TimeStage(lambda (X1, X2): finder.TwoPointSample(X1, X2), points, repeats)
+    stages['findLine'] = TimeStage(finder.FindLine, frames, repeats)
+    # Control, the motors are not really driven
+    samples = [finder.FindLine(frame) for frame in frames]
+    Settings.MonsterMotors = NoMotors
+    Settings.motorDispatcher = ImageProcessor.MotorDispatcher()
+    controller = ImageProcessor.ControlLoop()
+    try:
+        stages['controlLoop'] = TimeStage(controller.RunLoop, samples, repeats)
+        drives = [(Settings.currentSpeed, sample[1]) for sample in samples]
+        stages['motorDispatch'] = TimeStage(lambda (speed, steering): controller.SetDrive(speed, steering), drives, repeats)
+    finally:
+        controller.terminated = True
+        controller.event.set()
+        controller.join()
+        Settings.motorDispatcher.terminated = True
+        Settings.motorDispatcher.event.set()
+        Settings.motorDispatcher.join()
+    return stages
+
+# Print a table of the stage results
+def PrintStages(width, height, erodeSize, stages):
+    print
+    print 'Scaled to %dx%d with erodeSize %d:' % (width, height, erodeSize)
+    PrintStageTable(('flip', 'resize', 'flipResize', 'bands', 'colour', 'erode', 'sweepLine',
+                     'offsetMath', 'findLine', 'controlLoop', 'motorDispatch'), stages)
+
+# Print the results for the named stages in order
+def PrintStageTable(names, stages):
+    print '    %-14s %10s %9s %9s %9s' % ('Stage', 'Per second', 'p50 us', 'p95 us', 'p99 us')
+    for name in names:
+        if name in stages:
+            stage = stages[name]
+            print '    %-14s %10.0f %9.1f %9.1f %9.1f' % (name, stage['perSecond'], stage['p50Us'],
+                                                           stage['p95Us'], stage['p99Us'])
+
+# Run the stage benchmarks for each image and erosion size, then the full pipeline for each thread count
+# Returns the results ready to be saved as JSON
+def SweepStages(repeats, frameCount):
+    saved = dict([(name, getattr(Settings, name)) for name in
+                  ('scaledWidth', 'scaledHeight', 'targetY1', 'targetY2', 'targetRows', 'erodeSize', 'processingThreads')])
+    results = {'camera': {'width': Settings.cameraWidth, 'height': Settings.cameraHeight,
+                          'flippedImage': Settings.flippedImage},
+               'repeats': repeats,
+               'stages': [],
+               'pipeline': []}
+    source = FrameSource.SyntheticSource(False)
+    try:
+        for width, height in sweepSizes:
+            for erodeSize in sweepErodeSizes:
+                SetScaledSize(width, height)
+                Settings.erodeSize = erodeSize
+                stages = BenchmarkStages(source.frames, repeats)
+                results['stages'].append({'scaledWidth': width, 'scaledHeight': height,
+                                          'erodeSize': erodeSize, 'stages': stages})
+                PrintStages(width, height, erodeSize, stages)
+                for name, value in saved.items():
+                    setattr(Settings, name, value)
+        for threads in sweepThreads:
+            Settings.processingThreads = threads
+            fps = RunPipeline(False, frameCount)
+            results['pipeline'].append({'processingThreads': threads, 'useProcesses': False,
+                                        'frames': frameCount, 'fps': fps})
+    finally:
+        for name, value in saved.items():
+            setattr(Settings, name, value)
+        source.release()
+    print
+    print 'Full pipeline for %d frames:' % (frameCount)
+    for result in results['pipeline']:
+        print '    %d threads : %7.1f FPS' % (result['processingThreads'], result['fps'])
+    return results
+
+# Time the ThunderBorg driver calls used while driving against a simulated board
+# Returns the results for each of the driverBuses ready to be saved as JSON
+def BenchmarkDriver(repeats):
+    openBus = ThunderBorg.OpenBus
+    board = ThunderBorgSim.Install()
+    results = {'repeats': repeats, 'buses': []}
+    try:
+        TB = ThunderBorg.ThunderBorg()
+        TB.printFunction = TB.NoPrint
+        TB.Init()
+        # Levels which change every call, and the same levels again which SetBothMotors can skip
+        changing = [(i / 100.0, -i / 100.0) for i in range(-100, 101)]
+        steady = [(0.5, 0.5)]
+        for busName, byteTime, readErrorRate in driverBuses:
+            board.byteTime = byteTime
+            board.readErrorRate = readErrorRate
+            board.errorsInjected = 0
+            stages = {}
+            stages['setBothMotors'] = TimeStage(lambda (power1, power2): TB.SetBothMotors(power1, power2), changing, repeats)
+            stages['setBothSteady'] = TimeStage(lambda (power1, power2): TB.SetBothMotors(power1, power2), steady, repeats)
+            stages['setMotor1'] = TimeStage(lambda (power1, power2): TB.SetMotor1(power1), changing, repeats)
+            stages['getBattery'] = TimeStage(lambda value: TB.GetBatteryReading(), [None], repeats)
+            stages['getDriveFault1'] = TimeStage(lambda value: TB.GetDriveFault1(), [None], repeats)
+            results['buses'].append({'bus': busName, 'byteTime': byteTime, 'readErrorRate': readErrorRate,
+                                     'errorsInjected': board.errorsInjected, 'stages': stages})
+            print
+            print 'ThunderBorg driver, %s bus (%d errors injected):' % (busName, board.errorsInjected)
+            PrintStageTable(('setBothMotors', 'setBothSteady', 'setMotor1', 'getBattery', 'getDriveFault1'), stages)
+        TB.MotorsOff()
+    finally:
+        ThunderBorg.OpenBus = openBus
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the MonsterBorg processing using synthetic frames')
+    parser.add_argument('frames', nargs = '?', type = int, default = 1000,
+                        help = 'number of frames to run the full pipeline for')
+    parser.add_argument('--stages', action = 'store_true',
+                        help = 'time each processing stage, sweeping the image size, erodeSize, and processingThreads')
+    parser.add_argument('--driver', action = 'store_true',
+                        help = 'time the ThunderBorg driver against a simulated board')
+    parser.add_argument('--repeats', type = int, default = 500,
+                        help = 'number of times each stage is run')
+    parser.add_argument('--output', help = 'JSON file to save the stage or driver results to')
+    args = parser.parse_args()
+    # Settings for benchmarking, no display or motors
+    Settings.testMode = True
+    Settings.showImages = False
+    Settings.streamImages = False
+    Settings.showFps = False
+    if args.stages or args.driver:
+        if args.stages:
+            results = SweepStages(args.repeats, args.frames)
+        else:
+            results = BenchmarkDriver(args.repeats)
+        if args.output:
+            with open(args.output, 'w') as outputFile:
+                json.dump(results, outputFile, indent = 2, sort_keys = True)
+            print 'Results saved to "%s"' % (args.output)
+    else:
+        ComparePoolModes(args.frames)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+# Load library functions we want
+import sys
+import time
+import threading
+import socket
+import BaseHTTPServer
+import SocketServer
+import cv2
+import Settings
+import ImageProcessor
+
+# The display image is served as an MJPEG stream which most web browsers can show directly,
+# open http://<Raspberry Pi address>:<streamPort>/ to watch
+# A single encoder thread turns the display image into JPEG data shared by all of the viewers,
+# nothing is published, drawn, or encoded while nobody is watching
+
+streamBoundary = 'monsterframe'
+
+
+# HTTP server with a thread for each viewer
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, clientAddress):
+        # Viewers going away part way through a frame are expected, do not report them
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+
+# Sends the stream to a single viewer
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/stream.mjpg'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % (streamBoundary))
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.end_headers()
+        encoder = self.server.encoder
+        encoder.AddViewer()
+        try:
+            frameNumber = 0
+            while not encoder.terminated:
+                jpeg, frameNumber = encoder.WaitForFrame(frameNumber)
+                if jpeg is None:
+                    continue
+                self.wfile.write('--%s\r\n' % (streamBoundary))
+                self.wfile.write('Content-Type: image/jpeg\r\n')
+                self.wfile.write('Content-Length: %d\r\n\r\n' % (len(jpeg)))
+                self.wfile.write(jpeg)
+                self.wfile.write('\r\n')
+        except socket.error:
+            # The viewer has gone away
+            pass
+        finally:
+            encoder.RemoveViewer()
+
+    def log_message(self, format, *args):
+        # Keep the terminal for the FPS readings
+        pass
+
+
+# Stream encoding thread, also runs the HTTP server
+class StreamEncoder(threading.Thread):
+    def __init__(self):
+        super(StreamEncoder, self).__init__()
+        self.condition = threading.Condition()
+        self.terminated = False
+        self.viewers = 0
+        self.jpeg = None
+        self.frameNumber = 0
+        self.server = StreamServer((Settings.streamAddress, Settings.streamPort), StreamHandler)
+        self.server.encoder = self
+        self.serverThread = threading.Thread(target = self.server.serve_forever)
+        self.serverThread.start()
+        print 'Streaming images on port %d' % (Settings.streamPort)
+        self.start()
+
+    def AddViewer(self):
+        with self.condition:
+            self.viewers += 1
+            Settings.streamViewers = self.viewers
+            self.condition.notifyAll()
+
+    def RemoveViewer(self):
+        with self.condition:
+            self.viewers -= 1
+            Settings.streamViewers = self.viewers
+
+    # Wait for a newer frame than frameNumber, returns the JPEG data and its frame number
+    # The JPEG data is None if nothing new was encoded in time
+    def WaitForFrame(self, frameNumber):
+        with self.condition:
+            if self.frameNumber == frameNumber and not self.terminated:
+                self.condition.wait(1.0)
+            if self.frameNumber == frameNumber:
+                return None, frameNumber
+            return self.jpeg, self.frameNumber
+
+    def run(self):
+        # This method runs in a separate thread
+        frameInterval = 1.0 / Settings.streamPerSecond
+        encodeOptions = [cv2.cv.CV_IMWRITE_JPEG_QUALITY, Settings.streamQuality]
+        lastData = None
+        while not self.terminated:
+            # Sleep until someone is watching
+            with self.condition:
+                if self.viewers == 0:
+                    self.jpeg = None
+                    self.condition.wait(0.5)
+                    continue
+            startTime = time.time()
+            # Only encode when there are new results to show
+            displayData = Settings.displayData
+            if displayData is not lastData:
+                lastData = displayData
+                displayImage = ImageProcessor.GetDisplayFrame()
+                if displayImage is not None:
+                    ret, jpeg = cv2.imencode('.jpg', displayImage, encodeOptions)
+                    if ret:
+                        with self.condition:
+                            self.jpeg = jpeg.tostring()
+                            self.frameNumber += 1
+                            self.condition.notifyAll()
+            # Wait for the next frame to be due
+            delay = frameInterval - (time.time() - startTime)
+            if delay > 0:
+                time.sleep(delay)
+        # Wake up any viewers waiting for a frame and stop the server
+        with self.condition:
+            self.condition.notifyAll()
+        self.server.shutdown()
+        self.server.server_close()
+        self.serverThread.join()
+        print 'Stream encoder thread terminated'
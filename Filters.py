@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+# Load library functions we want
+import math
+import Settings
+
+# Smoothing filters for the motor output, each takes one value at a time:
+#   output = filter.Filter(value, timeStamp) returns the smoothed value
+#   filter.Reset() forgets all of the history
+# The time stamp is when the frame the value came from was captured, only the one-euro filter uses it
+# Every filter does a fixed amount of work for each value and keeps no growing lists
+
+
+# Make a filter of the type selected in the settings
+def MakeFilter():
+    if Settings.motorFilter == 'average':
+        return MovingAverage(Settings.motorSmoothing)
+    elif Settings.motorFilter == 'weighted':
+        if Settings.motorFilterWeights:
+            return WeightedAverage(Settings.motorFilterWeights)
+        else:
+            # Newest value counts the most, falling away in a straight line
+            return LinearWeightedAverage(Settings.motorSmoothing)
+    elif Settings.motorFilter == 'exponential':
+        if Settings.motorFilterAlpha:
+            alpha = Settings.motorFilterAlpha
+        else:
+            # Gives the same average delay as a moving average of motorSmoothing values
+            alpha = 2.0 / (Settings.motorSmoothing + 1)
+        return ExponentialAverage(alpha)
+    elif Settings.motorFilter == 'oneEuro':
+        return OneEuroFilter(Settings.oneEuroMinCutoff, Settings.oneEuroBeta, Settings.oneEuroDCutoff)
+    else:
+        raise ValueError('Unknown motorFilter "%s"' % (Settings.motorFilter))
+
+
+# Average of the last taps values, held in a ring buffer with a running total
+class MovingAverage(object):
+    def __init__(self, taps):
+        self.taps = max(int(taps), 1)
+        self.Reset()
+
+    def Reset(self):
+        self.history = [0.0] * self.taps
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def Filter(self, value, timeStamp = None):
+        if self.count < self.taps:
+            self.count += 1
+        else:
+            self.total -= self.history[self.index]
+        self.history[self.index] = value
+        self.total += value
+        self.index += 1
+        if self.index == self.taps:
+            # Add the total up again once per lap so rounding errors cannot build up
+            self.index = 0
+            self.total = sum(self.history)
+        return self.total / self.count
+
+
+# Weighted average of the last values, weights[0] is for the newest value
+# Until there are enough values only the weights for those we have are used
+# Any weights can be given, so each value goes through all of them, see LinearWeightedAverage for the default weights
+class WeightedAverage(object):
+    def __init__(self, weights):
+        self.weights = [float(weight) for weight in weights]
+        self.taps = len(self.weights)
+        self.Reset()
+
+    def Reset(self):
+        self.history = [0.0] * self.taps
+        self.index = 0
+        self.count = 0
+
+    def Filter(self, value, timeStamp = None):
+        self.index = (self.index - 1) % self.taps
+        self.history[self.index] = value
+        if self.count < self.taps:
+            self.count += 1
+        total = 0.0
+        weightTotal = 0.0
+        index = self.index
+        for weight in self.weights[:self.count]:
+            total += weight * self.history[index]
+            weightTotal += weight
+            index += 1
+            if index == self.taps:
+                index = 0
+        return total / weightTotal
+
+
+# Weighted average of the last taps values with weights falling in a straight line, taps for the newest value down to 1
+# Gives the same output as WeightedAverage with those weights, but keeps running totals instead of going through them
+class LinearWeightedAverage(object):
+    def __init__(self, taps):
+        self.taps = max(int(taps), 1)
+        self.Reset()
+
+    def Reset(self):
+        self.history = [0.0] * self.taps
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.weightedTotal = 0.0
+
+    def Filter(self, value, timeStamp = None):
+        # Each value we already have loses one from its weight, leaving the oldest with nothing once we are full
+        self.weightedTotal += self.taps * value - self.total
+        if self.count < self.taps:
+            self.count += 1
+        else:
+            self.total -= self.history[self.index]
+        self.history[self.index] = value
+        self.total += value
+        self.index += 1
+        if self.index == self.taps:
+            # Add the totals up again once per lap so rounding errors cannot build up, the oldest value is now first
+            self.index = 0
+            self.total = sum(self.history)
+            self.weightedTotal = sum([weight * old for weight, old in zip(range(1, self.taps + 1), self.history)])
+        weightTotal = self.count * (2 * self.taps - self.count + 1) / 2.0
+        return self.weightedTotal / weightTotal
+
+
+# Exponential moving average, each new value moves the output alpha of the way towards it
+class ExponentialAverage(object):
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.Reset()
+
+    def Reset(self):
+        self.output = None
+
+    def Filter(self, value, timeStamp = None):
+        if self.output is None:
+            self.output = value
+        else:
+            self.output += self.alpha * (value - self.output)
+        return self.output
+
+
+# One-euro filter, smooths heavily while the value is steady but follows quickly when it moves
+# The smoothing cut-off frequency rises from minCutoff (Hz) by beta for every unit per second the value is changing,
+# the rate of change itself is smoothed with a cut-off of dCutoff (Hz)
+class OneEuroFilter(object):
+    def __init__(self, minCutoff, beta, dCutoff):
+        self.minCutoff = minCutoff
+        self.beta = beta
+        self.dCutoff = dCutoff
+        self.Reset()
+
+    def Reset(self):
+        self.output = None
+        self.rate = 0.0
+        self.lastTime = None
+
+    # Share of the new value to use for a given cut-off frequency and time step
+    def Alpha(self, cutoff, interval):
+        tau = 1.0 / (2.0 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / interval)
+
+    def Filter(self, value, timeStamp = None):
+        # Without usable time stamps assume the camera frame rate
+        if (timeStamp is None) or (self.lastTime is None) or (timeStamp <= self.lastTime):
+            interval = 1.0 / Settings.frameRate
+        else:
+            interval = timeStamp - self.lastTime
+        self.lastTime = timeStamp
+        if self.output is None:
+            self.output = value
+            return value
+        rate = (value - self.output) / interval
+        self.rate += self.Alpha(self.dCutoff, interval) * (rate - self.rate)
+        cutoff = self.minCutoff + self.beta * abs(self.rate)
+        self.output += self.Alpha(cutoff, interval) * (value - self.output)
+        return self.output
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+# Load library functions we want
+import os
+import time
+import cv2
+import numpy
+import Settings
+
+# Each frame source behaves like a cv2.VideoCapture as far as the processing is concerned:
+#   ret, frame = source.read(buffer) reads the next frame, into buffer when possible
+#   source.isOpened() is True when frames can be read
+#   source.release() closes the source
+# Frames are always delivered at Settings.cameraWidth by Settings.cameraHeight
+
+imageExtensions = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+# Open the frame source selected in the settings, returns None if it cannot be opened
+def OpenFrameSource():
+    if Settings.frameSource == 'camera':
+        source = CameraSource()
+    elif Settings.frameSource == 'file':
+        if not Settings.sourcePath:
+            print 'No sourcePath set for file playback'
+            return None
+        source = FileSource(Settings.sourcePath, Settings.sourceRealTime, Settings.sourceLoop)
+    elif Settings.frameSource == 'synthetic':
+        source = SyntheticSource(Settings.sourceRealTime)
+    else:
+        print 'Unknown frame source "%s"' % (Settings.frameSource)
+        return None
+    if not source.isOpened():
+        return None
+    return source
+
+
+# Common frame source code, mostly for pacing playback to the frame rate
+class FrameSource(object):
+    def __init__(self, realTime, frameRate):
+        self.realTime = realTime
+        self.frameInterval = 1.0 / frameRate
+        self.nextFrameTime = None
+
+    # Wait until the next frame is due when playing back in real time
+    def Pace(self):
+        if not self.realTime:
+            return
+        now = time.time()
+        if self.nextFrameTime is None:
+            self.nextFrameTime = now
+        else:
+            self.nextFrameTime += self.frameInterval
+            delay = self.nextFrameTime - now
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.frameInterval:
+                # We have fallen behind, do not try and catch up
+                self.nextFrameTime = now
+
+    # Copy a frame into the buffer, resizing if it does not match the camera settings
+    def Deliver(self, frame, buffer):
+        if buffer is None:
+            buffer = numpy.empty((Settings.cameraHeight, Settings.cameraWidth, 3), numpy.uint8)
+        if frame.shape[:2] == buffer.shape[:2]:
+            buffer[...] = frame
+        else:
+            cv2.resize(frame, (buffer.shape[1], buffer.shape[0]), buffer, interpolation = cv2.INTER_NEAREST)
+        return True, buffer
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+
+# Live V4L2 camera
+class CameraSource(FrameSource):
+    def __init__(self, device = 0):
+        super(CameraSource, self).__init__(False, Settings.frameRate)
+        # Only load the camera driver if it is not already running
+        if not os.path.exists('/dev/video%d' % (device)):
+            os.system('sudo modprobe bcm2835-v4l2')
+        self.capture = cv2.VideoCapture(device)
+        self.capture.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, Settings.cameraWidth)
+        self.capture.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, Settings.cameraHeight)
+        self.capture.set(cv2.cv.CV_CAP_PROP_FPS, Settings.frameRate)
+        if not self.capture.isOpened():
+            self.capture.open(device)
+            if not self.capture.isOpened():
+                print 'Failed to open the camera'
+
+    def read(self, buffer = None):
+        # The camera paces itself, read straight into the buffer
+        return self.capture.read(buffer)
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def release(self):
+        self.capture.release()
+
+
+# Recorded video file or a directory of images
+class FileSource(FrameSource):
+    def __init__(self, path, realTime = True, loop = False):
+        self.path = path
+        self.loop = loop
+        self.capture = None
+        self.images = None
+        if os.path.isdir(path):
+            # Directory of images, played in name order at the camera frame rate
+            self.images = sorted([os.path.join(path, name) for name in os.listdir(path)
+                                  if os.path.splitext(name)[1].lower() in imageExtensions])
+            self.imageIndex = 0
+            frameRate = Settings.frameRate
+            self.opened = len(self.images) > 0
+            if self.opened:
+                print 'Playing %d images from "%s"' % (len(self.images), path)
+            else:
+                print 'No images found in "%s"' % (path)
+        else:
+            # Video file, played at the frame rate it was recorded at
+            self.capture = cv2.VideoCapture(path)
+            frameRate = self.capture.get(cv2.cv.CV_CAP_PROP_FPS)
+            if not (frameRate > 0):
+                frameRate = Settings.frameRate
+            self.opened = self.capture.isOpened()
+            if self.opened:
+                print 'Playing video "%s" at %.1f FPS' % (path, frameRate)
+            else:
+                print 'Failed to open video "%s"' % (path)
+        if not realTime:
+            print 'Playback is as fast as possible'
+        super(FileSource, self).__init__(realTime, frameRate)
+
+    def read(self, buffer = None):
+        if self.images is not None:
+            if self.imageIndex >= len(self.images):
+                if self.loop and self.images:
+                    self.imageIndex = 0
+                else:
+                    return False, None
+            frame = cv2.imread(self.images[self.imageIndex])
+            self.imageIndex += 1
+            if frame is None:
+                print 'Failed to read "%s"' % (self.images[self.imageIndex - 1])
+                return False, None
+            self.Pace()
+            return self.Deliver(frame, buffer)
+        else:
+            ret, frame = self.capture.read()
+            if not ret and self.loop:
+                # Restart from the beginning of the video
+                self.capture.release()
+                self.capture.open(self.path)
+                ret, frame = self.capture.read()
+            if not ret:
+                return False, None
+            self.Pace()
+            return self.Deliver(frame, buffer)
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        if self.capture:
+            self.capture.release()
+
+
+# Generated frames of a coloured line weaving across the view, held in memory
+class SyntheticSource(FrameSource):
+    def __init__(self, realTime = True, frameCount = None):
+        super(SyntheticSource, self).__init__(realTime, Settings.frameRate)
+        if frameCount is None:
+            frameCount = 2 * Settings.frameRate
+        width = Settings.cameraWidth
+        height = Settings.cameraHeight
+        # Line in the middle of the hunt colour range on a background outside of it
+        lineColour = [(low + high) / 2 for low, high in zip(Settings.minHuntColour, Settings.maxHuntColour)]
+        backColour = list(lineColour)
+        for i in range(3):
+            if Settings.minHuntColour[i] > 0:
+                backColour[i] = Settings.minHuntColour[i] / 2
+                break
+            elif Settings.maxHuntColour[i] < 255:
+                backColour[i] = (Settings.maxHuntColour[i] + 256) / 2
+                break
+        lineBGR = numpy.array(lineColour[::-1], numpy.uint8)
+        backBGR = numpy.array(backColour[::-1], numpy.uint8)
+        # The line bends across the image and sweeps side to side over the cycle
+        columns = numpy.arange(width)
+        rows = numpy.arange(height) / float(height)
+        halfWidth = width / 12
+        self.frames = []
+        for i in range(frameCount):
+            phase = (2.0 * numpy.pi * i) / frameCount
+            centres = (width / 2) + (width / 4) * numpy.sin(phase + 2.0 * rows)
+            lineMask = numpy.abs(columns[numpy.newaxis, :] - centres[:, numpy.newaxis]) < halfWidth
+            frame = numpy.empty((height, width, 3), numpy.uint8)
+            frame[...] = backBGR
+            frame[lineMask] = lineBGR
+            self.frames.append(frame)
+        self.frameIndex = 0
+        print 'Generated %d synthetic frames' % (frameCount)
+
+    def read(self, buffer = None):
+        frame = self.frames[self.frameIndex]
+        self.frameIndex = (self.frameIndex + 1) % len(self.frames)
+        self.Pace()
+        return self.Deliver(frame, buffer)
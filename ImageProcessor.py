@@ -5,11 +5,16 @@
 import time
 import datetime
 import threading
+import multiprocessing
+import multiprocessing.sharedctypes
+import ctypes
+import signal
 import cv2
 import numpy
 import math
 import random
 import Settings
+import Filters
 
 def rgb2bgr((r, g, b)):
     return b, g, r
@@ -20,28 +25,52 @@ class ControlLoop(threading.Thread):
         super(ControlLoop, self).__init__()
         self.event = threading.Event()
         self.lock = threading.Lock()
+        self.sampleLock = threading.Lock()
         self.terminated = False
-        self.eventWait = 2.0 / Settings.frameRate
+        self.nextSample = None
+        self.newestFrame = -1
+        self.lastFrame = -1
+        self.staleSamples = 0
+        self.droppedSamples = 0
+        self.ready = threading.Event()
         self.Reset()
-        print 'Control loop thread started with idle time of %.2fs' % (self.eventWait)
+        print 'Control loop thread started'
         self.start()
 
     def run(self):
         # This method runs in a separate thread
+        self.ready.set()
         while not self.terminated:
-            # Wait for an image to be written to the stream
-            self.event.wait(self.eventWait)
+            # Wait for a processor to post a result, without a timeout so we wake as soon as it arrives
+            self.event.wait()
             if self.event.isSet():
                 if self.terminated:
                     break
-                try:
-                    # Read the next set of values
-                    sample = self.nextSample
-                    self.RunLoop(sample)
-                finally:
-                    # Reset the event trigger
+                # Take the newest set of values, leaving the slot free for the next result
+                with self.sampleLock:
                     self.event.clear()
-        print 'Control loop thread terminated'
+                    nextSample = self.nextSample
+                    self.nextSample = None
+                if nextSample:
+                    self.lastFrame, self.lastFrameStamp, sample = nextSample
+                    self.RunLoop(sample)
+        print 'Control loop thread terminated (%d stale results ignored, %d results replaced before use)' % (
+                self.staleSamples, self.droppedSamples)
+
+    def PostSample(self, frame, frameStamp, sample):
+        # Called by the processors with the result for a frame
+        # Results are only accepted if they are newer than anything already accepted,
+        # so a slow processor can never replace the result of a later frame
+        with self.sampleLock:
+            if frame <= self.newestFrame:
+                self.staleSamples += 1
+                return
+            if self.nextSample:
+                # The previous result was never used
+                self.droppedSamples += 1
+            self.nextSample = (frame, frameStamp, sample)
+            self.newestFrame = frame
+        self.event.set()
 
     def Reset(self):
         with self.lock:
@@ -54,13 +83,14 @@ class ControlLoop(threading.Thread):
         self.changeI = 0.0
         self.clipIMax = Settings.clipI
         self.clipIMin = -Settings.clipI
-        self.firTaps = Settings.motorSmoothing
-        self.firHistorySpeed = []
-        self.firHistorySteering = []
+        self.speedFilter = Filters.MakeFilter()
+        self.steeringFilter = Filters.MakeFilter()
         self.lastSteering = 0.0
         self.lastSpeed = 0.0
         self.lastPosition = 0.0
         self.lastChange = 0.0
+        self.lastFrameStamp = 0.0
+        self.lastGoodStamp = 0.0
         self.SetDrive(0.0, 0.0)
     
     def SetDrive(self, speed, steering):
@@ -89,40 +119,56 @@ class ControlLoop(threading.Thread):
         elif steering > 0.01:
             # Turning right
             driveRight *= 1.0 - steering
-        # Set the motors to the new speeds
-        Settings.MonsterMotors(driveLeft, driveRight)
+        # Hand the new speeds to the motor output thread
+        Settings.motorDispatcher.Post(driveLeft, driveRight, self.lastFrameStamp)
     
-    def FirFilter(self, speed, steering):
-        # Filtering for speed and steering
-        self.firHistorySpeed.append(speed)
-        self.firHistorySteering.append(steering)
-        self.firHistorySpeed = self.firHistorySpeed[-self.firTaps:]
-        self.firHistorySteering = self.firHistorySteering[-self.firTaps:]
-        filteredSpeed = numpy.mean(self.firHistorySpeed)
-        filteredSteering = numpy.mean(self.firHistorySteering)
+    def SmoothDrive(self, speed, steering):
+        # Filtering for speed and steering, see Filters.py
+        filteredSpeed = self.speedFilter.Filter(speed, self.lastFrameStamp)
+        filteredSteering = self.steeringFilter.Filter(steering, self.lastFrameStamp)
         self.SetDrive(filteredSpeed, filteredSteering)
 
     def RunLoop(self, (isGood, position, change)):
         with self.lock:
             if isGood:
+                # Time since the last frame the line was found on, the I and D gains are per second
+                # After a long gap the last readings are too old to use for the D terms
+                if self.lastGoodStamp and (self.lastFrameStamp > self.lastGoodStamp):
+                    interval = self.lastFrameStamp - self.lastGoodStamp
+                else:
+                    interval = None
+                self.lastGoodStamp = self.lastFrameStamp
+                if (interval == None) or (interval > Settings.maxControlInterval):
+                    useD = False
+                    interval = min(1.0 / Settings.frameRate, Settings.maxControlInterval)
+                else:
+                    # Frames arriving close together, such as buffered camera frames, would make the D terms jump
+                    useD = True
+                    interval = max(interval, Settings.minControlInterval)
                 # Position offset loop
                 self.positionP = Settings.positionP * position
-                self.positionI += Settings.positionI * position
+                self.positionI += Settings.positionI * position * interval
                 if self.positionI > self.clipIMax:
                     self.positionI = self.clipIMax
                 elif self.positionI < self.clipIMin:
                     self.positionI = self.clipIMin
-                self.positionD = Settings.positionD * (position - self.lastPosition)
+                if useD:
+                    self.positionD = Settings.positionD * (position - self.lastPosition) / interval
+                else:
+                    self.positionD = 0.0
                 self.lastPosition = position
                 self.positionPID = self.positionP + self.positionI + self.positionD
                 # Position change loop
                 self.changeP = Settings.changeP * change
-                self.changeI += Settings.changeI * change
+                self.changeI += Settings.changeI * change * interval
                 if self.changeI > self.clipIMax:
                     self.changeI = self.clipIMax
                 elif self.changeI < self.clipIMin:
                     self.changeI = self.clipIMin
-                self.changeD = Settings.changeD * (change - self.lastChange)
+                if useD:
+                    self.changeD = Settings.changeD * (change - self.lastChange) / interval
+                else:
+                    self.changeD = 0.0
                 self.lastChange = change
                 self.changePID = self.changeP + self.changeI + self.changeD
                 # Speed and steering values
@@ -136,154 +182,388 @@ class ControlLoop(threading.Thread):
                     speed = 0.0
                 steering = self.lastSteering
             # Set the final drive
-            self.FirFilter(speed, steering)
+            self.SmoothDrive(speed, steering)
             self.lastSpeed = speed
             self.lastSteering = steering
     
 
-# Image stream processing thread
-class StreamProcessor(threading.Thread):
-    def __init__(self, name):
-        super(StreamProcessor, self).__init__()
+# Motor output thread
+# The control loop posts the latest drive levels and carries on without waiting for the motors to be set
+# Only the newest levels are kept, any posted while a write is in progress replace each other
+# A keep-alive thread posts the last levels again when nothing has been written for motorKeepAlive seconds,
+# so the ThunderBorg failsafe does not stop the motors when the frame rate is low
+# It only does this for maxControlInterval seconds after the control loop last posted levels,
+# if the control loop stops the failsafe is left to stop the motors
+class MotorDispatcher(threading.Thread):
+    def __init__(self):
+        super(MotorDispatcher, self).__init__()
         self.event = threading.Event()
+        self.lock = threading.Lock()
         self.terminated = False
-        self.name = str(name)
-        self.eventWait = (2.0 * Settings.processingThreads) / Settings.frameRate
-        if Settings.cameraWidth != Settings.scaledWidth or Settings.cameraHeight != Settings.scaledHeight:
-            self.resize = True
-        else:
-            self.resize = False
-        print 'Processor thread %s started with idle time of %.2fs' % (self.name, self.eventWait)
+        self.nextDrive = None
+        self.writes = 0
+        self.coalesced = 0
+        self.writeTotal = 0.0
+        self.writeMax = 0.0
+        self.lastDrive = None
+        self.lastWriteTime = time.time()
+        self.lastPostTime = time.time()
+        self.keepAlivePending = False
+        self.ready = threading.Event()
+        print 'Motor dispatcher thread started'
         self.start()
+        if Settings.testMode:
+            # Nothing to keep alive, and the extra calls would put the test output out of step
+            self.keepAliveThread = None
+        else:
+            self.keepAliveThread = threading.Thread(target = self.KeepAlive)
+            self.keepAliveThread.start()
+
+    def Post(self, driveLeft, driveRight, frameStamp):
+        # Called by the control loop, frameStamp is the capture time of the frame the levels are for
+        with self.lock:
+            if self.nextDrive and not self.keepAlivePending:
+                # The previous levels were never written
+                self.coalesced += 1
+            self.nextDrive = (driveLeft, driveRight, frameStamp)
+            self.keepAlivePending = False
+            self.lastPostTime = time.time()
+        self.event.set()
+
+    def KeepAlive(self):
+        # This method runs in a separate thread
+        while not self.terminated:
+            time.sleep(Settings.motorKeepAlive / 4.0)
+            with self.lock:
+                # Only fill an empty mailbox, so newly posted levels are never replaced by older ones
+                now = time.time()
+                if (self.lastDrive and (not self.nextDrive) and
+                        (now - self.lastWriteTime) >= Settings.motorKeepAlive and
+                        (now - self.lastPostTime) < Settings.maxControlInterval):
+                    self.nextDrive = (self.lastDrive[0], self.lastDrive[1], None)
+                    self.keepAlivePending = True
+                    self.event.set()
 
     def run(self):
         # This method runs in a separate thread
+        self.ready.set()
         while not self.terminated:
-            # Wait for an image to be written to the stream
-            self.event.wait(self.eventWait)
-            if self.event.isSet():
-                if self.terminated:
-                    break
-                try:
-                    # grab the image and do some processing on it
-                    if Settings.flippedImage:
-                        image = cv2.flip(self.nextFrame, -1)
-                    else:
-                        image = self.nextFrame
-                    self.ProcessImage(image)
-                finally:
-                    # Reset the event
-                    self.nextFrame = None
-                    self.event.clear()
-                    # Return ourselves to the pool at the back
-                    with Settings.frameLock:
-                        Settings.processorPool.insert(0, self)
-        print 'Processor thread %s terminated' % (self.name)
-    
-    # Find sections in a boolean image
+            # Wait for new levels to be posted
+            self.event.wait()
+            if self.terminated:
+                break
+            with self.lock:
+                self.event.clear()
+                nextDrive = self.nextDrive
+                self.nextDrive = None
+                self.keepAlivePending = False
+                if nextDrive:
+                    # Taken as written now, so the keep-alive cannot post older levels while this write is going on
+                    self.lastDrive = nextDrive[:2]
+                    self.lastWriteTime = time.time()
+            if nextDrive:
+                driveLeft, driveRight, frameStamp = nextDrive
+                writeStart = time.time()
+                Settings.MonsterMotors(driveLeft, driveRight)
+                writeEnd = time.time()
+                # Record how long the write took, and the time from capturing the frame
+                writeTime = writeEnd - writeStart
+                self.writes += 1
+                self.writeTotal += writeTime
+                if writeTime > self.writeMax:
+                    self.writeMax = writeTime
+                if frameStamp:
+                    Settings.pipelineStats.RecordLatency(writeEnd - frameStamp)
+        if self.keepAliveThread:
+            self.keepAliveThread.join()
+        if self.writes > 0:
+            print 'Motor dispatcher thread terminated (%d writes, %.2f ms average, %.2f ms max, %d levels replaced before being written)' % (
+                    self.writes, self.writeTotal * 1000.0 / self.writes, self.writeMax * 1000.0, self.coalesced)
+        else:
+            print 'Motor dispatcher thread terminated'
+
+
+# Colour matching for the line, gives a mask of 255 for matching pixels and 0 for the rest
+# The plain minHuntColour to maxHuntColour box is matched using cv2.inRange, huntColourRegions are matched using
+# a lookup table with an entry for every colour quantised to colourTableBits per channel
+# Either way the matching is only set up again when the settings change
+class ColourClassifier(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.settings = None
+        self.key = None
+        self.matcher = None
+
+    # Check the settings and rebuild the matching if they have changed
+    # The settings are changed by assigning new values, so while the same values are in place they are the same objects
+    # and the check is quick, the full key is only worked out when one of them has been replaced
+    def Update(self):
+        settings = (Settings.minHuntColour, Settings.maxHuntColour, Settings.huntColourRegions, Settings.colourTableBits)
+        if settings == self.settings:
+            return
+        with self.lock:
+            if settings == self.settings:
+                return
+            minHuntColour, maxHuntColour, huntColourRegions, colourTableBits = settings
+            if huntColourRegions:
+                regions = tuple([(space, tuple(minimum), tuple(maximum)) for space, minimum, maximum in huntColourRegions])
+            else:
+                regions = None
+            key = (tuple(minHuntColour), tuple(maxHuntColour), regions, colourTableBits)
+            if key != self.key:
+                # The mode is kept with what it uses so Classify always sees a matching pair
+                if regions:
+                    self.matcher = ('table', self.BuildTable(regions, colourTableBits), colourTableBits)
+                else:
+                    self.matcher = ('range', numpy.array(rgb2bgr(minHuntColour)), numpy.array(rgb2bgr(maxHuntColour)))
+                self.key = key
+            self.settings = settings
+
+    # Build the lookup table for a list of colour regions, a colour matches if it is in any of them
+    # Each region is ('rgb' or 'hsv', minimum, maximum), HSV uses the OpenCV ranges of 0-179 for hue and 0-255 otherwise
+    # A hue minimum larger than the maximum wraps around through red
+    # Each table entry is decided by the lowest colour it covers
+    def BuildTable(self, regions, bits):
+        levels = numpy.arange(1 << bits, dtype = numpy.uint8) << (8 - bits)
+        blue, green, red = numpy.meshgrid(levels, levels, levels, indexing = 'ij')
+        colours = numpy.dstack((blue.ravel(), green.ravel(), red.ravel()))
+        hsv = None
+        table = numpy.zeros(colours.shape[1], dtype = numpy.bool_)
+        for space, minimum, maximum in regions:
+            if space == 'rgb':
+                values = colours[0]
+                minimum = rgb2bgr(minimum)
+                maximum = rgb2bgr(maximum)
+            elif space == 'hsv':
+                if hsv is None:
+                    hsv = cv2.cvtColor(colours, cv2.COLOR_BGR2HSV)
+                values = hsv[0]
+            else:
+                raise ValueError('Unknown colour space "%s" in huntColourRegions' % (space))
+            inRegion = numpy.ones(len(table), dtype = numpy.bool_)
+            for i in range(3):
+                if (space == 'hsv') and (i == 0) and (minimum[0] > maximum[0]):
+                    inRegion &= (values[:, 0] >= minimum[0]) | (values[:, 0] <= maximum[0])
+                else:
+                    inRegion &= (values[:, i] >= minimum[i]) & (values[:, i] <= maximum[i])
+            table |= inRegion
+        print 'Colour lookup table built with %d of %d colours matching' % (numpy.count_nonzero(table), len(table))
+        return table.astype(numpy.uint8) * 255
+
+    def Classify(self, image):
+        self.Update()
+        matcher = self.matcher
+        if matcher[0] == 'range':
+            mode, minBGR, maxBGR = matcher
+            return cv2.inRange(image, minBGR, maxBGR)
+        else:
+            # Build each pixel's table index from its quantised blue, green, and red levels
+            mode, table, bits = matcher
+            blue, green, red = cv2.split(image >> (8 - bits))
+            index = blue.astype(numpy.uint32)
+            index <<= bits
+            index |= green
+            index <<= bits
+            index |= red
+            return table.take(index)
+
+colourClassifier = ColourClassifier()
+
+
+# Line finding for a single image, used by both the processing threads and processes
+class LineFinder(object):
+    def __init__(self, name, showImages):
+        self.name = name
+        if Settings.cameraWidth != Settings.scaledWidth or Settings.cameraHeight != Settings.scaledHeight:
+            self.resize = True
+        else:
+            self.resize = False
+        # Rows to find the line on, either a list to fit a line or curve through, or just our two target points
+        if Settings.targetRows:
+            self.fitRows = True
+            self.targetRows = sorted(set(Settings.targetRows), reverse = True)
+        else:
+            self.fitRows = False
+            self.targetRows = [Settings.targetY1, Settings.targetY2]
+        self.rowPositions = numpy.array(self.targetRows, dtype = numpy.float64)
+        self.nearY = max(self.targetRows)
+        self.farY = min(self.targetRows)
+        self.rowConfidence = numpy.zeros(len(self.targetRows))
+        # Band processing cannot produce the full image needed for display,
+        # the stream only needs it while someone is watching so both ways are kept ready for it
+        self.showImages = showImages
+        self.showFrame = False
+        self.bandProcessing = Settings.bandProcessing and not (showImages and Settings.showImages)
+        if self.bandProcessing:
+            self.SetupBands()
+        if (not self.bandProcessing) or showImages:
+            if Settings.flippedImage and self.resize:
+                self.pixelMap = self.BuildPixelMap(range(Settings.scaledHeight))
+
+    # Build a map for cv2.remap which flips and shrinks the camera image in a single pass
+    # Each scaled pixel is given the camera pixel that cv2.flip followed by an INTER_NEAREST cv2.resize would pick,
+    # using the same calculation as OpenCV so the results match exactly
+    def BuildPixelMap(self, scaledRows):
+        scaleX = 1.0 / (float(Settings.scaledWidth) / Settings.cameraWidth)
+        scaleY = 1.0 / (float(Settings.scaledHeight) / Settings.cameraHeight)
+        columns = [min(int(math.floor(X * scaleX)), Settings.cameraWidth - 1) for X in range(Settings.scaledWidth)]
+        rows = [min(int(math.floor(Y * scaleY)), Settings.cameraHeight - 1) for Y in scaledRows]
+        columns = numpy.array(columns, dtype = numpy.float32)
+        rows = numpy.array(rows, dtype = numpy.float32)
+        if Settings.flippedImage:
+            columns = (Settings.cameraWidth - 1) - columns
+            rows = (Settings.cameraHeight - 1) - rows
+        mapX = numpy.tile(columns, (len(rows), 1))
+        mapY = numpy.tile(rows[:, numpy.newaxis], (1, len(columns)))
+        pixelMap, unused = cv2.convertMaps(mapX, mapY, cv2.CV_16SC2, nninterpolation = True)
+        return pixelMap
+
+    # Work out which rows of the scaled image are needed to find the line at each of the target rows
+    # Each target row needs the rows the erosion looks at either side of it, nothing else is used
+    def SetupBands(self):
+        if Settings.erodeSize > 1:
+            marginAbove = Settings.erodeSize // 2
+            marginBelow = Settings.erodeSize - 1 - marginAbove
+        else:
+            marginAbove = 0
+            marginBelow = 0
+        rows = set()
+        for Y in self.targetRows:
+            rows.update(range(max(0, Y - marginAbove), min(Settings.scaledHeight, Y + marginBelow + 1)))
+        self.bandRows = sorted(rows)
+        self.bandTargets = [self.bandRows.index(Y) for Y in self.targetRows]
+        self.bandMap = self.BuildPixelMap(self.bandRows)
+        print 'Processor %s using %d of %d rows' % (self.name, len(self.bandRows), Settings.scaledHeight)
+
+    # Cut the band rows out of a camera image, flipped and scaled to match the full processing
+    # The bands are stacked together, this is safe as each target row has its whole erosion margin
+    # within its own band, and only the first and last bands can touch the image edges
+    def GrabBands(self, image):
+        return cv2.remap(image, self.bandMap, None, cv2.INTER_NEAREST)
+
+    # Find sections in a boolean image for a single row
     # Returns a list of size and location pairs sorted by largest first
     def SweepLine(self, image, Y):
-        # Grab the line of interest
-        line = image[Y, :]
-        width = len(line)
-        # Work out where the changes are
-        changed = numpy.where(line[:-1] != line[1:])[0]
-        # Set an initial state with an edge at the start of the line
-        current = line.item(0)
-        previousPosition = 0
-        sectionsFound = []
-        # Sweep over the list of changes
-        for i in changed:
-            # Filter out changes at the edge of the image
-            # These can be messy from the camera
-            if i < 2:
-                pass
-            elif i > (width - 3):
-                pass
-            elif current:
-                # End of high section - add to list
-                size = i - previousPosition
-                location = int(size / 2) + previousPosition
-                sectionsFound.append([size, location])
-                previousPosition = i
-            else:
-                # End of low section, mark the next start point
-                previousPosition = i
-            current = not current
-        # If we finished on a high section generate a final section for it
-        # This includes the whole line being active!
-        if current:
-            size = width - previousPosition
-            location = int(size / 2) + previousPosition
-            sectionsFound.append([size, location])
-        # Finally sort by size and return
+        sectionRows, sizes, centres = self.SweepLines(image, [Y])
+        sectionsFound = [[int(size), int(centre)] for size, centre in zip(sizes, centres)]
         sectionsFound.sort()
         sectionsFound.reverse()
         return sectionsFound
 
-    # Image processing function
-    def ProcessImage(self, image):
-        # Frame rate counter
-        with Settings.frameLock:
-            self.frame = Settings.frameCounter
-            Settings.frameAnnounce += 1
-            Settings.frameCounter += 1
-            if Settings.frameAnnounce == Settings.fpsInterval:
-                frameStamp = time.time()
-                if Settings.showFps:
-                    fps = Settings.fpsInterval / (frameStamp - Settings.lastFrameStamp)
-                    fps = '%.1f FPS' % (fps)
-                    print fps
-                Settings.frameAnnounce = 0
-                Settings.lastFrameStamp = frameStamp
-        # Resize if needed
-        if self.resize:
-            image = cv2.resize(image, (Settings.scaledWidth, Settings.scaledHeight), interpolation = cv2.INTER_NEAREST)
+    # Find sections in a boolean image for any number of rows at once
+    # Returns arrays of the row number (index into rows), size, and centre for every section found
+    def SweepLines(self, image, rows):
+        # Grab the lines of interest
+        lines = image[rows, :] != 0
+        width = lines.shape[1]
+        # Work out where the changes are, i is a change if pixels i and i + 1 differ
+        # Changes at the edge of the image are filtered out as these can be messy from the camera,
+        # they still swap between high and low, but they do not start or end a section
+        changed = lines[:, 2:width - 2] != lines[:, 3:width - 1]
+        changeRows, changes = numpy.nonzero(changed)
+        changes += 2
+        # Each change marks the start of the next section, so every section starts at the previous
+        # change on the same row, or at the start of the row for the first one
+        firstOnRow = numpy.ones(len(changes), dtype = numpy.bool_)
+        firstOnRow[1:] = changeRows[1:] != changeRows[:-1]
+        starts = numpy.zeros(len(changes), dtype = numpy.intp)
+        starts[1:] = changes[:-1]
+        starts[firstOnRow] = 0
+        # A change from high to low is the end of a high section
+        endsHigh = lines[changeRows, changes]
+        sectionRows = changeRows[endsHigh]
+        sizes = changes[endsHigh] - starts[endsHigh]
+        sectionStarts = starts[endsHigh]
+        # Rows finishing on a high section have a final section from their last change,
+        # this includes the whole row being active!
+        lastOnRow = numpy.ones(len(changes), dtype = numpy.bool_)
+        lastOnRow[:-1] = changeRows[:-1] != changeRows[1:]
+        lastChange = numpy.zeros(len(rows), dtype = numpy.intp)
+        lastChange[changeRows[lastOnRow]] = changes[lastOnRow]
+        finalRows = numpy.nonzero(lines[:, -1])[0]
+        finalStarts = lastChange[finalRows]
+        sectionRows = numpy.concatenate((sectionRows, finalRows))
+        sizes = numpy.concatenate((sizes, width - finalStarts))
+        sectionStarts = numpy.concatenate((sectionStarts, finalStarts))
+        centres = (sizes // 2) + sectionStarts
+        return sectionRows, sizes, centres
+
+    # Pick the largest section on each row, when two are the same size the right-most is used
+    # Returns arrays of the centre and size of the section picked for each row, rows without a section have -1 for both
+    def LargestSections(self, rowCount, sectionRows, sizes, centres):
+        largestCentres = numpy.empty(rowCount, dtype = numpy.intp)
+        largestSizes = numpy.empty(rowCount, dtype = numpy.intp)
+        largestCentres.fill(-1)
+        largestSizes.fill(-1)
+        if len(sectionRows) > 0:
+            order = numpy.lexsort((centres, sizes, sectionRows))
+            sortedRows = sectionRows[order]
+            isLargest = numpy.ones(len(order), dtype = numpy.bool_)
+            isLargest[:-1] = sortedRows[:-1] != sortedRows[1:]
+            largestCentres[sortedRows[isLargest]] = centres[order][isLargest]
+            largestSizes[sortedRows[isLargest]] = sizes[order][isLargest]
+        return largestCentres, largestSizes
+
+    # Finds the line in a camera image and works out the values for the control loop
+    # Returns isGood, offset, change
+    def FindLine(self, image):
+        # The results are only drawn from when they are going to be shown
+        self.showFrame = self.showImages and (Settings.showImages or Settings.streamViewers > 0)
+        if self.bandProcessing and not self.showFrame:
+            # Only the rows around our target lines are needed
+            image = self.GrabBands(image)
+            scanRows = self.bandTargets
+        else:
+            # Flip and resize the whole image if needed
+            if Settings.flippedImage and self.resize:
+                image = cv2.remap(image, self.pixelMap, None, cv2.INTER_NEAREST)
+            elif Settings.flippedImage:
+                image = cv2.flip(image, -1)
+            elif self.resize:
+                image = cv2.resize(image, (Settings.scaledWidth, Settings.scaledHeight), interpolation = cv2.INTER_NEAREST)
+            elif self.showFrame:
+                # The frame buffer is reused once we are done, the display needs its own copy
+                image = image.copy()
+            scanRows = self.targetRows
         # Process image to get a lineMask image (boolean)
-        minBGR = numpy.array((Settings.minHuntColour[2], Settings.minHuntColour[1], Settings.minHuntColour[0]))
-        maxBGR = numpy.array((Settings.maxHuntColour[2], Settings.maxHuntColour[1], Settings.maxHuntColour[0]))
-        lineMask = cv2.inRange(image, minBGR, maxBGR)
+        lineMask = colourClassifier.Classify(image)
         # Erode the mask to remove noise
         if Settings.erodeSize > 1:
             erodeKernel = numpy.ones((Settings.erodeSize, Settings.erodeSize), numpy.uint8)
             lineMask   = cv2.erode(lineMask, erodeKernel)
-        # Find the line sections in our two locations
-        sectionsY1 = self.SweepLine(lineMask, Settings.targetY1)
-        sectionsY2 = self.SweepLine(lineMask, Settings.targetY2)
+        # Find the line sections in each of our target rows
+        sectionRows, sizes, centres = self.SweepLines(lineMask, scanRows)
         # Pick the largest sections and take their center positions
-        if len(sectionsY1) > 0:
-            X1 = sectionsY1[0][1]
+        largestCentres, largestSizes = self.LargestSections(len(scanRows), sectionRows, sizes, centres)
+        if self.fitRows:
+            return self.FitRows(image, lineMask, sectionRows, sizes, largestCentres, largestSizes)
+        if largestCentres[0] >= 0:
+            X1 = int(largestCentres[0])
         else:
             X1 = None
-        if len(sectionsY2) > 0:
-            X2 = sectionsY2[0][1]
+        if largestCentres[1] >= 0:
+            X2 = int(largestCentres[1])
         else:
             X2 = None
-        # Generate the display image
-        if Settings.showImages:
-            if Settings.overlayOriginal:
-                displayImage = image.copy()
-                # Darken areas not matching the mask
-                blue, green, red = cv2.split(displayImage)
-                red  [lineMask == 0] /= 3
-                green[lineMask == 0] /= 3
-                blue [lineMask == 0] /= 3
-                displayImage = cv2.merge([blue, green, red])
-            else:
-                # Generate grey image from mask
-                displayImage = cv2.merge([lineMask, lineMask, lineMask])
-                displayImage /= 2
-            # Draw line between points
-            if (X1 != None) and (X2 != None):
-                cv2.line(displayImage, (X1, Settings.targetY1), (X2, Settings.targetY2), Settings.targetLine, 1, lineType = cv2.CV_AA)
-            # Draw circles around points
+        # Pass the results to the display
+        if self.showFrame:
+            points = []
             if X1 != None:
-                cv2.circle(displayImage, (X1, Settings.targetY1), Settings.targetPointSize, Settings.targetPoints, 1, lineType = cv2.CV_AA) 
+                points.append((X1, Settings.targetY1, 1.0))
             if X2 != None:
-                cv2.circle(displayImage, (X2, Settings.targetY2), Settings.targetPointSize, Settings.targetPoints, 1, lineType = cv2.CV_AA) 
-            Settings.displayFrame = displayImage
+                points.append((X2, Settings.targetY2, 1.0))
+            if (X1 != None) and (X2 != None):
+                curve = [(X1, Settings.targetY1), (X2, Settings.targetY2)]
+            else:
+                curve = []
+            self.PublishDisplay(image, lineMask, points, curve)
         # Pass the results to the control loop
-        # Offset is most important, but ideally we need both
+        return self.TwoPointSample(X1, X2)
+
+    # Work out the values for the control loop from the line positions on the two target rows
+    # Offset is most important, but ideally we need both
+    # Returns isGood, offset, change
+    def TwoPointSample(self, X1, X2):
         if (X1 == None) and (X2 == None):
             # No line found
             isGood = False
@@ -306,36 +586,324 @@ class StreamProcessor(threading.Thread):
             isGood = True
             offset = ((2.0 * X1) / Settings.scaledWidth) - 1.0
             change = (2.0 * (X2 - X1)) / Settings.scaledWidth
-        Settings.controller.nextSample = (isGood, offset, change)
-        Settings.controller.event.set()
+        return isGood, offset, change
+
+    # Fit a line or curve through the centres found on each of the target rows
+    # Each row is weighted by its confidence, the share of the highlighted pixels on that row in the section used
+    # Returns isGood, offset, change, with change being the heading of the fit from the nearest to the furthest row
+    def FitRows(self, image, lineMask, sectionRows, sizes, largestCentres, largestSizes):
+        found = largestCentres >= 0
+        foundCount = numpy.count_nonzero(found)
+        rowTotals = numpy.bincount(sectionRows, weights = sizes, minlength = len(self.targetRows))
+        self.rowConfidence = numpy.zeros(len(self.targetRows))
+        self.rowConfidence[found] = largestSizes[found] / rowTotals[found]
+        if foundCount == 0:
+            # No line found
+            isGood = False
+            offset = 0.0
+            change = 0.0
+            fit = None
+        else:
+            # Fewer rows than needed for the curve reduces the order, with a single row we only get an offset
+            order = min(Settings.trackingFitOrder, foundCount - 1)
+            fit = numpy.polyfit(self.rowPositions[found], largestCentres[found], order, w = self.rowConfidence[found])
+            nearX, farX = numpy.polyval(fit, (self.nearY, self.farY))
+            isGood = True
+            offset = ((2.0 * nearX) / Settings.scaledWidth) - 1.0
+            change = (2.0 * (farX - nearX)) / Settings.scaledWidth
+        # Pass the results to the display
+        if self.showFrame:
+            points = [(int(X), int(Y), confidence) for X, Y, confidence in
+                      zip(largestCentres[found], numpy.array(self.targetRows)[found], self.rowConfidence[found])]
+            if fit is None:
+                curve = []
+            else:
+                curveY = numpy.arange(self.farY, self.nearY + 1)
+                curveX = numpy.polyval(fit, curveY)
+                curve = zip(curveX.round().astype(int), curveY)
+            self.PublishDisplay(image, lineMask, points, curve)
+        return isGood, offset, change
+
+    # Hand the results to the display, the display image is only drawn when it is shown, see GetDisplayFrame
+    # points are (X, Y, confidence) for each row the line was found on, curve is a list of (X, Y) to draw through
+    def PublishDisplay(self, image, lineMask, points, curve):
+        Settings.displayData = (image, lineMask, points, curve)
+
+
+# Generate the display image from the latest processing results, None if there are none yet
+# This is called when an image is about to be shown, keeping the drawing out of the processing
+def GetDisplayFrame():
+    displayData = Settings.displayData
+    if displayData is None:
+        return None
+    image, lineMask, points, curve = displayData
+    if Settings.overlayOriginal:
+        # Darken areas not matching the mask
+        blue, green, red = cv2.split(image)
+        red  [lineMask == 0] /= 3
+        green[lineMask == 0] /= 3
+        blue [lineMask == 0] /= 3
+        displayImage = cv2.merge([blue, green, red])
+    else:
+        # Generate grey image from mask
+        displayImage = cv2.merge([lineMask, lineMask, lineMask])
+        displayImage /= 2
+    # Draw line between points
+    if len(curve) > 1:
+        cv2.polylines(displayImage, [numpy.array(curve, dtype = numpy.int32)], False, Settings.targetLine, 1, lineType = cv2.CV_AA)
+    # Draw circles around points, dimmer for lower confidence
+    for X, Y, confidence in points:
+        colour = [level * confidence for level in Settings.targetPoints]
+        cv2.circle(displayImage, (X, Y), Settings.targetPointSize, colour, 1, lineType = cv2.CV_AA)
+    return displayImage
+
+
+# Image stream processing thread
+class StreamProcessor(threading.Thread):
+    def __init__(self, name):
+        super(StreamProcessor, self).__init__()
+        self.event = threading.Event()
+        self.terminated = False
+        self.name = str(name)
+        self.framesProcessed = 0
+        self.failed = False
+        self.ready = threading.Event()
+        self.SetupFinder()
+        print 'Processor thread %s started' % (self.name)
+        self.start()
+
+    def SetupFinder(self):
+        self.finder = LineFinder(self.name, Settings.showImages or Settings.streamImages)
+
+    def run(self):
+        # This method runs in a separate thread
+        self.ready.set()
+        while not self.terminated:
+            # Sleep until the capture thread hands us an image
+            self.event.wait()
+            if self.event.isSet():
+                if self.terminated:
+                    break
+                try:
+                    # grab the image and do some processing on it
+                    self.ProcessImage(self.nextFrame, self.nextIndex, self.nextStamp)
+                    # Only this thread changes the count, it is added up with the others when reported
+                    self.framesProcessed += 1
+                finally:
+                    # Hand the frame buffer back and reset the event
+                    Settings.framePool.Return(self.nextFrame)
+                    self.nextFrame = None
+                    self.event.clear()
+                    # Return ourselves to the pool at the back, unless we cannot take any more frames
+                    if not self.failed:
+                        Settings.processorPool.Put(self)
+        print 'Processor thread %s terminated' % (self.name)
+
+    # Image processing function
+    def ProcessImage(self, image, frameIndex, captureTime):
+        sample = self.finder.FindLine(image)
+        Settings.controller.PostSample(frameIndex, captureTime, sample)
+
+
+# Image processing in a separate worker process
+# This thread stands in for a StreamProcessor, the worker process reads the frame straight out of the
+# shared memory frame pool and only the small (isGood, offset, change) sample is sent back
+# Display images are not available from the worker processes
+class ProcessWorker(StreamProcessor):
+    def SetupFinder(self):
+        # The line finding is done by the worker process instead of this thread
+        self.connection, workerConnection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target = ProcessWorkerMain,
+                                               args = (self.name, workerConnection, Settings.framePool.sharedArrays))
+        self.process.daemon = True
+        self.process.start()
+        # Only the worker process keeps its end open, so we see the pipe close if it dies
+        workerConnection.close()
+
+    def run(self):
+        # The worker process says when it is ready to take frames, stop waiting if it dies first
+        while not self.terminated:
+            try:
+                if self.connection.poll(0.1):
+                    self.connection.recv()
+                    break
+                elif not self.process.is_alive():
+                    raise EOFError
+            except EOFError:
+                print 'Processor process %s ended before it was ready' % (self.name)
+                self.terminated = True
+        if self.terminated:
+            # Never marked as ready, so the startup wait gives up rather than sending frames here
+            print 'Processor thread %s terminated' % (self.name)
+        else:
+            super(ProcessWorker, self).run()
+        # Tell the worker process to finish
+        if self.process.is_alive():
+            self.connection.send(None)
+        self.process.join()
+
+    # Image processing function
+    def ProcessImage(self, image, frameIndex, captureTime):
+        try:
+            self.connection.send(Settings.framePool.SlotIndex(image))
+            sample = self.connection.recv()
+        except (EOFError, IOError):
+            # The worker process has died, without it the frames would stop being processed
+            print 'Processor process %s stopped unexpectedly, shutting down!' % (self.name)
+            self.failed = True
+            self.terminated = True
+            Settings.running = False
+            return
+        Settings.controller.PostSample(frameIndex, captureTime, sample)
+
+
+# Main loop for the worker processes
+def ProcessWorkerMain(name, connection, sharedArrays):
+    # CTRL+C is handled by the main process, which will tell us when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    finder = LineFinder(name, False)
+    frames = [SharedFrame(sharedArray) for sharedArray in sharedArrays]
+    connection.send(True)
+    while True:
+        slot = connection.recv()
+        if slot is None:
+            break
+        connection.send(finder.FindLine(frames[slot]))
+
+
+# Image shaped numpy view of a shared memory frame buffer
+def SharedFrame(sharedArray):
+    return numpy.frombuffer(sharedArray, dtype = numpy.uint8).reshape((Settings.cameraHeight, Settings.cameraWidth, 3))
+
+
+# Pool of idle processing threads
+# The capture thread blocks until a processor is handed back instead of polling for one
+class ProcessorPool(object):
+    def __init__(self, processors):
+        self.condition = threading.Condition(threading.Lock())
+        self.processors = list(processors)
+        self.idle = list(processors)
+        self.closed = False
+        self.waitCount = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+    def Get(self):
+        # Returns the oldest idle processor, or None once the pool is closed
+        with self.condition:
+            if not self.idle and not self.closed:
+                # Starved, wait to be woken by a processor being returned
+                waitStart = time.time()
+                while not self.idle and not self.closed:
+                    self.condition.wait()
+                waited = time.time() - waitStart
+                self.waitCount += 1
+                self.waitTotal += waited
+                if waited > self.waitMax:
+                    self.waitMax = waited
+            if self.closed:
+                return None
+            return self.idle.pop()
+
+    def Put(self, processor):
+        # Returns a processor to the back of the pool and wakes the capture thread if it is waiting
+        with self.condition:
+            self.idle.insert(0, processor)
+            self.condition.notify()
+
+    def Close(self):
+        # Wakes anything waiting on the pool so it can shut down
+        with self.condition:
+            self.closed = True
+            self.condition.notifyAll()
+
+    def GetWaitStats(self):
+        # Returns the number of starved frames with their average and longest wait, then resets the counts
+        # The wait counts belong to the capture thread, which is the only caller of both this and Get
+        waitCount = self.waitCount
+        if waitCount > 0:
+            waitAverage = self.waitTotal / waitCount
+        else:
+            waitAverage = 0.0
+        waitMax = self.waitMax
+        self.waitCount = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        return waitCount, waitAverage, waitMax
+
+
+# Pool of preallocated frame buffers, one slot for each processor
+# The capture thread reads straight into a borrowed buffer and the processor returns it when done
+# With shared set the buffers are in shared memory so worker processes can read them directly
+class FramePool(object):
+    def __init__(self, size, shared = False):
+        self.lock = threading.Lock()
+        self.shared = shared
+        if shared:
+            frameBytes = Settings.cameraHeight * Settings.cameraWidth * 3
+            self.sharedArrays = [multiprocessing.sharedctypes.RawArray(ctypes.c_uint8, frameBytes) for i in range(size)]
+            self.free = [SharedFrame(sharedArray) for sharedArray in self.sharedArrays]
+            self.slots = dict([(id(buffer), i) for i, buffer in enumerate(self.free)])
+            print 'Frame pool of %d shared buffers allocated' % (size)
+        else:
+            self.free = [numpy.empty((Settings.cameraHeight, Settings.cameraWidth, 3), numpy.uint8) for i in range(size)]
+            print 'Frame pool of %d buffers allocated' % (size)
+
+    def SlotIndex(self, buffer):
+        # Position of a shared buffer, this matches the order of sharedArrays
+        return self.slots[id(buffer)]
+
+    def Borrow(self):
+        with self.lock:
+            return self.free.pop()
+
+    def Return(self, buffer):
+        # If the camera delivered a different size OpenCV will have allocated a new array,
+        # in that case it replaces the original buffer in the pool
+        with self.lock:
+            self.free.append(buffer)
 
 
 # Image capture thread
 class ImageCapture(threading.Thread):
     def __init__(self):
         super(ImageCapture, self).__init__()
+        self.firstFrame = threading.Event()
         self.start()
 
     # Stream delegation loop
     def run(self):
         while Settings.running:
-            # Grab the oldest unused processor thread
-            with Settings.frameLock:
-                if Settings.processorPool:
-                    processor = Settings.processorPool.pop()
-                else:
-                    processor = None
+            # Grab the oldest unused processor thread, waiting for one to be free if needed
+            processor = Settings.processorPool.Get()
             if processor:
-                # Grab the next frame and send it to the processor
-                ret, frame = Settings.capture.read()
+                # Grab the next frame directly into a free buffer and send it to the processor
+                buffer = Settings.framePool.Borrow()
+                ret, frame = Settings.capture.read(buffer)
+                if ret and (frame is not buffer) and Settings.framePool.shared:
+                    # Shared buffers cannot be replaced, copy the frame into the one we borrowed
+                    if frame.shape == buffer.shape:
+                        buffer[...] = frame
+                    else:
+                        cv2.resize(frame, (buffer.shape[1], buffer.shape[0]), buffer, interpolation = cv2.INTER_NEAREST)
+                    frame = buffer
                 if ret:
-                    processor.nextFrame = frame.copy()
+                    # Stamp the frame with its sequence number and capture time
+                    processor.nextFrame = frame
+                    processor.nextIndex = Settings.frameCounter
+                    processor.nextStamp = time.time()
+                    Settings.frameCounter += 1
                     processor.event.set()
+                    if not self.firstFrame.isSet():
+                        self.firstFrame.set()
+                    if Settings.showFps and (Settings.frameCounter % Settings.fpsInterval == 0):
+                        print Settings.pipelineStats.Summary()
                 else:
+                    Settings.framePool.Return(buffer)
                     print 'Capture stream lost...'
                     Settings.running = False
                     break
             else:
-                # When the pool is starved we wait a while to allow a processor to finish
-                time.sleep(0.01)
+                # The pool has been closed
+                break
         print 'Streaming terminated.'
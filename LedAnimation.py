@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+# Load library functions we want
+import math
+import time
+import threading
+import numpy
+import ThunderBorg
+import Settings
+
+# External LED strip (SK9822 / APA102C) output for the ThunderBorg
+# Frames are numpy arrays of [r, g, b] rows, one for each LED, with levels from 0 to 1
+# An animation is a function called as animation(seconds, colours), where seconds is the time since it
+# started playing, it fills in colours for the frame to show at that time
+
+
+# Packs frames of colours into the packets sent by ThunderBorg.WriteExternalLedPackets
+# The packets are built once and only the colour bytes are changed for each frame
+class FramePacker(object):
+    def __init__(self, ledCount):
+        self.packets = numpy.zeros((ledCount + 1, ThunderBorg.EXTERNAL_LED_PACKET), numpy.uint8)
+        self.packets[:, 0] = ThunderBorg.COMMAND_WRITE_EXTERNAL_LED
+        # The first packet is the start marker, the rest are full brightness followed by blue, green, red
+        self.packets[1:, 1] = ThunderBorg.PWM_MAX
+        self.levels = numpy.empty((ledCount, 3), numpy.float32)
+
+    def Pack(self, colours):
+        numpy.multiply(colours[:, ::-1], ThunderBorg.PWM_MAX, self.levels)
+        numpy.clip(self.levels, 0, ThunderBorg.PWM_MAX, self.levels)
+        self.packets[1:, 2:] = self.levels
+        return self.packets.tostring()
+
+
+# Set all of the LEDs to a single frame of colours straight away
+def ShowFrame(board, colours):
+    board.WriteExternalLedPackets(FramePacker(len(colours)).Pack(numpy.asarray(colours)))
+
+
+# Animation player thread, shows frames from the current animation at up to framesPerSecond
+# Frames which are the same as the last one are not sent, and the ThunderBorg lets motor writes go first
+class LedPlayer(threading.Thread):
+    def __init__(self, board, ledCount, framesPerSecond):
+        super(LedPlayer, self).__init__()
+        self.board = board
+        self.event = threading.Event()
+        self.terminated = False
+        self.animation = None
+        self.startTime = time.time()
+        self.frameInterval = 1.0 / framesPerSecond
+        self.packer = FramePacker(ledCount)
+        self.colours = numpy.zeros((ledCount, 3), numpy.float32)
+        self.lastPackets = None
+        self.framesSent = 0
+        self.start()
+
+    # Start playing a new animation from the beginning
+    def Play(self, animation):
+        self.animation = animation
+        self.startTime = time.time()
+        self.event.set()
+
+    def run(self):
+        # This method runs in a separate thread
+        nextFrameTime = time.time()
+        while not self.terminated:
+            animation = self.animation
+            if animation:
+                animation(time.time() - self.startTime, self.colours)
+                packets = self.packer.Pack(self.colours)
+                if packets != self.lastPackets:
+                    self.board.WriteExternalLedPackets(packets)
+                    self.lastPackets = packets
+                    self.framesSent += 1
+            # Sleep until the next frame is due or the animation is changed
+            nextFrameTime = max(nextFrameTime + self.frameInterval, time.time())
+            self.event.wait(nextFrameTime - time.time())
+            self.event.clear()
+        print 'LED player thread terminated (%d frames sent)' % (self.framesSent)
+
+
+# Animation showing a single colour
+def Solid(colour):
+    def Animation(seconds, colours):
+        colours[:] = colour
+    return Animation
+
+
+# Animation fading a colour up and down once every period seconds
+def Pulse(colour, period):
+    def Animation(seconds, colours):
+        level = 0.5 - 0.5 * math.cos(2.0 * math.pi * seconds / period)
+        colours[:] = numpy.multiply(colour, level)
+    return Animation
+
+
+# Animation showing the battery level as a bar, green for charged and red for empty, using the telemetry readings
+def BatteryLevel(board, minimum = ThunderBorg.BATTERY_MIN_DEFAULT, maximum = Settings.voltageIn):
+    def Animation(seconds, colours):
+        voltage, readTime = board.GetTelemetry('battery')
+        if voltage is None:
+            colours[:] = 0.0
+            return
+        level = min(max((voltage - minimum) / (maximum - minimum), 0.0), 1.0)
+        lit = int(round(level * len(colours)))
+        colours[:lit] = (1.0 - level, level, 0.0)
+        colours[lit:] = 0.0
+    return Animation
+
+
+# Animation showing if the line is being followed, a green chase while it is and flashing red once it has been lost
+def LineStatus(lostTime = 0.5):
+    def Animation(seconds, colours):
+        lastGoodStamp = Settings.controller.lastGoodStamp
+        if (lastGoodStamp > 0) and (time.time() - lastGoodStamp) < lostTime:
+            colours[:] = 0.0
+            colours[int(seconds * 10) % len(colours)] = (0.0, 1.0, 0.0)
+        elif int(seconds * 4) % 2 == 0:
+            colours[:] = (1.0, 0.0, 0.0)
+        else:
+            colours[:] = 0.0
+    return Animation
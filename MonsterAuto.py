@@ -13,8 +13,13 @@ import threading
 import cv2
 import numpy
 import ThunderBorg
+import ThunderBorgSim
+import LedAnimation
 import Settings
 import ImageProcessor
+import FrameSource
+import DebugStream
+import PipelineStats
 print 'Libraries loaded'
 
 # Derive some settings from the main settings
@@ -31,41 +36,84 @@ scriptDir = os.path.dirname(sys.argv[0])
 os.chdir(scriptDir)
 print 'Running script in directory "%s"' % (scriptDir)
 
+# Time taken by each part of the startup
+startupPhases = []
+phaseStart = time.time()
+
+def PhaseDone(name):
+    global phaseStart
+    now = time.time()
+    startupPhases.append((name, now - phaseStart))
+    phaseStart = now
+
+# Wait for each of the events to be set, gives up if they are not all set within startupTimeout
+def WaitForReady(events):
+    giveUpTime = time.time() + Settings.startupTimeout
+    for event in events:
+        if not event.wait(max(giveUpTime - time.time(), 0.0)):
+            return False
+    return True
+
+# Blink the LEDs in white to indicate startup, stops early if the script is ending
+def BlinkLeds():
+    TB.SetLedShowBattery(False)
+    for i in range(3):
+        TB.SetLeds(0,0,0)
+        time.sleep(0.5)
+        TB.SetLeds(1,1,1)
+        time.sleep(0.5)
+        if not Settings.running:
+            break
+    TB.SetLedShowBattery(True)
+
 if Settings.testMode:
     print 'TEST MODE: Skipping board setup'
 else:
     # Setup the ThunderBorg
+    boardCacheFile = Settings.boardCacheFile
+    if Settings.simulateBoard:
+        print 'Using a simulated ThunderBorg'
+        ThunderBorgSim.Install()
+        # Do not leave the simulated board behind for the real one to be looked for at
+        boardCacheFile = None
     global TB
     TB = ThunderBorg.ThunderBorg()
-    #TB.i2cAddress = 0x15                  # Uncomment and change the value if you have changed the board address
+    # Find the board, checking where it was found last time and its configured address before searching
+    boards = ThunderBorg.FindThunderBorg(cacheFile = boardCacheFile, expected = [(TB.busNumber, TB.i2cAddress)])
+    if len(boards) == 0:
+        print 'No ThunderBorg found, check you are attached :)'
+        sys.exit()
+    elif len(boards) > 1:
+        print 'Found %d ThunderBorg boards, using the first one' % (len(boards))
+    TB.busNumber, TB.i2cAddress = boards[0]
     TB.Init()
     if not TB.foundChip:
-        boards = ThunderBorg.ScanForThunderBorg()
-        if len(boards) == 0:
-            print 'No ThunderBorg found, check you are attached :)'
-        else:
-            print 'No ThunderBorg at address %02X, but we did find boards:' % (TB.i2cAddress)
-            for board in boards:
-                print '    %02X (%d)' % (board, board)
-            print 'If you need to change the IC address change the setup line so it is correct, e.g.'
-            print 'TB.i2cAddress = 0x%02X' % (boards[0])
+        print 'The ThunderBorg at %02X stopped responding, check you are attached :)' % (TB.i2cAddress)
         sys.exit()
-    TB.SetCommsFailsafe(False)
+    TB.SetCommsFailsafe(Settings.motorFailsafe)
 
-    # Blink the LEDs in white to indicate startup
-    TB.SetLedShowBattery(False)
-    for i in range(3):
-        TB.SetLeds(0,0,0)
-        time.sleep(0.5)
-        TB.SetLeds(1,1,1)
-        time.sleep(0.5)
-    TB.SetLedShowBattery(True)
+    # Keep an eye on the battery and drive faults without holding up the motors
+    if Settings.pollTelemetry:
+        def ReportFault(name, value):
+            print 'WARNING: ThunderBorg reports %s, check the motor wiring' % (name)
+        TB.AddFaultCallback(ReportFault)
+        TB.StartTelemetry()
+    PhaseDone('board')
+
+    # Blink the LEDs while the rest of the startup carries on, or before it for the original slower startup
+    if Settings.fastStart:
+        ledThread = threading.Thread(target = BlinkLeds)
+        ledThread.daemon = True
+        ledThread.start()
+    else:
+        BlinkLeds()
+        PhaseDone('LEDs')
 
 # Function used by the processing to control the MonsterBorg
 def MonsterMotors(driveLeft, driveRight):
     global TB
-    TB.SetMotor1(driveRight * maxPower) # Right side motors
-    TB.SetMotor2(driveLeft  * maxPower) # Left side motors
+    # Motor 1 is the right side motors, motor 2 the left side motors
+    TB.SetBothMotors(driveRight * maxPower, driveLeft * maxPower)
 
 # Function used by the processing for motor output in test mode
 def TestModeMotors(driveLeft, driveRight):
@@ -85,40 +133,75 @@ else:
     Settings.MonsterMotors = MonsterMotors
 
 # Startup sequence
-print 'Setup camera input'
-os.system('sudo modprobe bcm2835-v4l2')
-Settings.capture = cv2.VideoCapture(0) 
-Settings.capture.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, Settings.cameraWidth);
-Settings.capture.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, Settings.cameraHeight);
-Settings.capture.set(cv2.cv.CV_CAP_PROP_FPS, Settings.frameRate);
-if not Settings.capture.isOpened():
-    Settings.capture.open()
-    if not Settings.capture.isOpened():
-        print 'Failed to open the camera'
-        sys.exit()
+print 'Setup %s input' % (Settings.frameSource)
+Settings.capture = FrameSource.OpenFrameSource()
+if not Settings.capture:
+    print 'Failed to open the %s input' % (Settings.frameSource)
+    sys.exit()
+PhaseDone('camera')
 
-print 'Setup stream processor threads'
-Settings.frameLock = threading.Lock()
-Settings.processorPool = [ImageProcessor.StreamProcessor(i+1) for i in range(Settings.processingThreads)]
-allProcessors = Settings.processorPool[:]
+Settings.pipelineStats = PipelineStats.PipelineStats()
+if Settings.useProcesses:
+    print 'Setup stream processor processes'
+    Settings.framePool = ImageProcessor.FramePool(Settings.processingThreads, True)
+    allProcessors = [ImageProcessor.ProcessWorker(i+1) for i in range(Settings.processingThreads)]
+else:
+    print 'Setup stream processor threads'
+    Settings.framePool = ImageProcessor.FramePool(Settings.processingThreads)
+    allProcessors = [ImageProcessor.StreamProcessor(i+1) for i in range(Settings.processingThreads)]
+Settings.processorPool = ImageProcessor.ProcessorPool(allProcessors)
 
 print 'Setup control loop'
+Settings.motorDispatcher = ImageProcessor.MotorDispatcher()
 Settings.controller = ImageProcessor.ControlLoop()
 
-print 'Wait ...'
-time.sleep(2)
+if Settings.streamImages:
+    print 'Setup image stream'
+    streamEncoder = DebugStream.StreamEncoder()
+
+# Wait for everything to be running before the frames start
+if not WaitForReady([processor.ready for processor in allProcessors] +
+                    [Settings.motorDispatcher.ready, Settings.controller.ready]):
+    print 'Processing threads did not start in time, shutting down!'
+    Settings.running = False
+PhaseDone('threads')
+if not Settings.fastStart:
+    print 'Wait ...'
+    time.sleep(2)
+    PhaseDone('wait')
+
 captureThread = ImageProcessor.ImageCapture()
+if Settings.running:
+    if WaitForReady([captureThread.firstFrame]):
+        PhaseDone('first frame')
+        print 'Ready after %.2f s (%s)' % (sum([seconds for name, seconds in startupPhases]),
+                                           ', '.join(['%s %.2f s' % (name, seconds) for name, seconds in startupPhases]))
+    else:
+        print 'No frames from the %s input, shutting down!' % (Settings.frameSource)
+        Settings.running = False
+
+# Show the line tracking or battery level on any external LEDs
+if (not Settings.testMode) and (Settings.externalLeds > 0):
+    ledPlayer = LedAnimation.LedPlayer(TB, Settings.externalLeds, Settings.ledFramesPerSecond)
+    if Settings.ledAnimation == 'battery':
+        ledPlayer.Play(LedAnimation.BatteryLevel(TB))
+    else:
+        ledPlayer.Play(LedAnimation.LineStatus())
 
 try:
     print 'Press CTRL+C to quit'
-    Settings.MonsterMotors(0, 0)
+    # All motor levels go through the dispatcher so they are written in order
+    Settings.motorDispatcher.Post(0, 0, None)
     # Create a window to show images if we need one
     if Settings.showImages:
         cv2.namedWindow('Monster view', cv2.WINDOW_NORMAL)
     # Loop indefinitely
     while Settings.running:
         # See if there is a frame to show, wait either way
-        monsterView = Settings.displayFrame
+        if Settings.showImages:
+            monsterView = ImageProcessor.GetDisplayFrame()
+        else:
+            monsterView = None
         if monsterView != None:
             if Settings.scaleFinalImage != 1.0:
                 size = (int(monsterView.shape[1] * Settings.scaleFinalImage), 
@@ -130,33 +213,52 @@ try:
             # Wait for the interval period
             time.sleep(showFrameDelay)
     # Disable all drives
-    Settings.MonsterMotors(0, 0)
+    Settings.motorDispatcher.Post(0, 0, None)
 except KeyboardInterrupt:
     # CTRL+C exit, disable all drives
     print '\nUser shutdown'
-    Settings.MonsterMotors(0, 0)
+    Settings.motorDispatcher.Post(0, 0, None)
 except:
     # Unexpected error, shut down!
     e = sys.exc_info()
     print
     print e
     print '\nUnexpected error, shutting down!'
-    Settings.MonsterMotors(0, 0)
+    Settings.motorDispatcher.Post(0, 0, None)
 # Tell each thread to stop, and wait for them to end
 Settings.running = False
+Settings.processorPool.Close()
 while allProcessors:
-    with Settings.frameLock:
-        processor = allProcessors.pop()
+    processor = allProcessors.pop()
     processor.terminated = True
     processor.event.set()
     processor.join()
 Settings.controller.terminated = True
+Settings.controller.event.set()
 Settings.controller.join()
+Settings.motorDispatcher.terminated = True
+Settings.motorDispatcher.event.set()
+Settings.motorDispatcher.join()
 captureThread.join()
+if Settings.streamImages:
+    streamEncoder.terminated = True
+    streamEncoder.join()
 Settings.capture.release()
 del Settings.capture
-Settings.MonsterMotors(0, 0)
-if not Settings.testMode:
+print Settings.pipelineStats.TotalSummary()
+if Settings.testMode:
+    Settings.MonsterMotors(0, 0)
+else:
+    # Stop the motors with a command which is always sent, even if they should already be stopped
+    TB.MotorsOff()
+    TB.StopTelemetry()
+    if Settings.fastStart:
+        ledThread.join()
+    if Settings.externalLeds > 0:
+        ledPlayer.terminated = True
+        ledPlayer.event.set()
+        ledPlayer.join()
+        LedAnimation.ShowFrame(TB, numpy.zeros((Settings.externalLeds, 3)))
     # Turn the LEDs off to indicate we are done
     TB.SetLedShowBattery(False)
     TB.SetLeds(0,0,0)
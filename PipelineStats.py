@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+# Load library functions we want
+import math
+import time
+import Settings
+
+# Latency is measured from the frame being captured to the motors being set for that frame
+# Times are counted into fixed histogram bins so recording is cheap and no samples are kept,
+# the bins are spaced logarithmically from 0.1 ms to 10 s, so percentiles are within about 6%
+
+binsPerDecade = 20
+minimumLatency = 0.0001
+histogramBins = 5 * binsPerDecade + 2      # Including a bin each for too small and too large
+
+
+# Counts of latencies in each bin, the counts are never reset
+class LatencyHistogram(object):
+    def __init__(self):
+        self.counts = [0] * histogramBins
+        self.total = 0
+
+    def Record(self, seconds):
+        if seconds < minimumLatency:
+            index = 0
+        else:
+            index = min(int(math.log10(seconds / minimumLatency) * binsPerDecade) + 1, histogramBins - 1)
+        self.counts[index] += 1
+        self.total += 1
+
+    # Copy of the counts so far, safe to call while another thread is recording
+    def Snapshot(self):
+        snapshot = LatencyHistogram()
+        snapshot.counts = self.counts[:]
+        snapshot.total = sum(snapshot.counts)
+        return snapshot
+
+    # Counts recorded since an earlier snapshot
+    def Since(self, earlier):
+        window = LatencyHistogram()
+        window.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        window.total = self.total - earlier.total
+        return window
+
+    # Latency in seconds below which the percentile of samples are, None if there are no samples
+    # Values are taken from the middle of the bin the percentile lands in
+    def Percentile(self, percentile):
+        if self.total == 0:
+            return None
+        wanted = self.total * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count > 0:
+                break
+        return minimumLatency * 10.0 ** ((index - 0.5) / binsPerDecade)
+
+
+# Rolling frame rate, latency, and dropped frame statistics for the whole pipeline
+# Nothing is locked, each count only has a single thread changing it and they are all added up
+# when the summary is made, the summary covers everything since the last one
+class PipelineStats(object):
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.lastLatency = LatencyHistogram()
+        self.lastFrames = 0
+        self.lastTime = time.time()
+        self.lastStale = 0
+        self.lastDropped = 0
+        self.lastCoalesced = 0
+
+    # Called by the motor output thread once the motors have been set for a frame
+    def RecordLatency(self, seconds):
+        self.latency.Record(seconds)
+
+    # Make the summary line for the frames since the last summary, called by the capture thread
+    def Summary(self):
+        # Frames finished by all of the processors
+        now = time.time()
+        frames = sum([processor.framesProcessed for processor in Settings.processorPool.processors])
+        line = '%.1f FPS' % ((frames - self.lastFrames) / (now - self.lastTime))
+        self.lastFrames = frames
+        self.lastTime = now
+        # Latency of the frames which reached the motors
+        latency = self.latency.Snapshot()
+        window = latency.Since(self.lastLatency)
+        self.lastLatency = latency
+        if window.total > 0:
+            line += ', latency %s' % (LatencyText(window))
+        # Results thrown away by the control loop
+        staleSamples = Settings.controller.staleSamples
+        droppedSamples = Settings.controller.droppedSamples
+        if (staleSamples > self.lastStale) or (droppedSamples > self.lastDropped):
+            line += ', %d late and %d replaced results dropped' % (
+                    staleSamples - self.lastStale, droppedSamples - self.lastDropped)
+        self.lastStale = staleSamples
+        self.lastDropped = droppedSamples
+        # Motor levels replaced before the motors could be set
+        coalesced = Settings.motorDispatcher.coalesced
+        if coalesced > self.lastCoalesced:
+            line += ', %d motor levels replaced before being written' % (coalesced - self.lastCoalesced)
+        self.lastCoalesced = coalesced
+        # Frames held up waiting for a processor
+        waitCount, waitAverage, waitMax = Settings.processorPool.GetWaitStats()
+        if waitCount > 0:
+            line += ', %d frames waited for a processor (%.1f ms average, %.1f ms max)' % (
+                    waitCount, waitAverage * 1000.0, waitMax * 1000.0)
+        return line
+
+    # Make the summary line for the whole run
+    def TotalSummary(self):
+        totals = self.latency.Snapshot()
+        if totals.total == 0:
+            return 'No frames reached the motors'
+        return '%d frames reached the motors, latency %s' % (totals.total, LatencyText(totals))
+
+
+# Latency percentiles for display
+def LatencyText(histogram):
+    p50, p95, p99 = [histogram.Percentile(percentile) * 1000.0 for percentile in (50, 95, 99)]
+    return '%.1f / %.1f / %.1f ms (p50 / p95 / p99)' % (p50, p95, p99)
@@ -8,6 +8,14 @@
 # Power settings
 voltageIn = 1.2 * 10                    # Total battery voltage to the ThunderBorg
 voltageOut = 12.0 * 0.95                # Maximum motor voltage, we limit it to 95% to allow the RPi to get uninterrupted power
+motorFailsafe = True                    # True to have the ThunderBorg stop the motors if they are not updated for 1/4 of a second
+motorKeepAlive = 0.05                   # Seconds without new motor levels before the last ones are posted again, half the ThunderBorg MOTOR_KEEP_ALIVE, only for maxControlInterval after the last new levels
+pollTelemetry = True                    # True to read the battery level and drive faults from the ThunderBorg in the background
+simulateBoard = False                   # True to drive the simulated ThunderBorg from ThunderBorgSim.py instead of a real board
+boardCacheFile = '~/.thunderborg'       # File remembering where the ThunderBorg was found so it does not need to be searched for, None to always search
+externalLeds = 0                        # Number of SK9822 / APA102C LEDs attached to the ThunderBorg, 0 for none
+ledAnimation = 'line'                   # What the external LEDs show, 'line' for line tracking or 'battery' for the battery level (needs pollTelemetry)
+ledFramesPerSecond = 10                 # Most times per second the external LEDs are updated
 
 # Camera settings
 cameraWidth  = 640                      # Camera image width
@@ -15,25 +23,45 @@ cameraHeight = 480                      # Camera image height
 frameRate    = 30                       # Camera image capture frame rate
 flippedImage = True                     # True if the camera needs to be rotated
 
+# Frame source settings
+frameSource = 'camera'                  # Where frames come from, 'camera', 'file' (video file or image directory), or 'synthetic'
+sourcePath = None                       # Video file or directory of images to play back when frameSource is 'file'
+sourceRealTime = True                   # True to play back files and synthetic frames at their frame rate, False for as fast as possible
+sourceLoop = False                      # True to restart file playback from the beginning when it ends
+
 # Processing settings
 scaledWidth   = 160                     # Resized image width
 scaledHeight  = 120                     # Resized image height
 processingThreads = 4                   # Number of processing threads to run
+useProcesses = False                    # True to run the processing in separate processes with frames in shared memory, no images are shown in this mode
 minHuntColour = ( 80,   0,   0)         # Minimum RGB values for our coloured line
 maxHuntColour = (255, 100, 100)         # Maximum RGB values for our coloured line
+huntColourRegions = None                # List of ('rgb' or 'hsv', minimum, maximum) colour regions to match instead of the two values above, None to use them
+colourTableBits = 6                     # Bits per channel for the huntColourRegions lookup table, 6 uses a 256 KB table
 erodeSize = 5                           # Size of the erosion used to remove noise, larger reduces noise further
 targetY1 = int(scaledHeight * 0.9)      # Y location for the closest point to track in the scaled image
 targetY2 = int(scaledHeight * 0.6)      # Y location for the furthest point to track in the scaled image
+targetRows = None                       # List of Y locations to fit the line through in the scaled image, None tracks targetY1 and targetY2 only
+trackingFitOrder = 1                    # Order of the fit through targetRows, 1 for a straight line, 2 for a curve
+bandProcessing = True                   # True to only process the rows around the target rows, not used when showImages is True or while the image stream is watched
 
 # Control settings
 motorSmoothing = 5                      # Number of frames to average motor output for, larger is slower to respond but drives smoother
+motorFilter = 'average'                 # Motor output smoothing, 'average', 'weighted', 'exponential', or 'oneEuro', see Filters.py
+motorFilterWeights = None               # Weights for 'weighted', newest frame first, None for motorSmoothing weights falling in a straight line
+motorFilterAlpha = None                 # Share of each new value used by 'exponential', None to match the delay of motorSmoothing frames
+oneEuroMinCutoff = 1.0                  # Smoothing cut-off frequency in Hz for 'oneEuro' while the output is steady
+oneEuroBeta = 0.5                       # Increase in the 'oneEuro' cut-off frequency for each unit per second the output is changing
+oneEuroDCutoff = 1.0                    # Cut-off frequency in Hz for smoothing the rate of change for 'oneEuro'
 positionP = 1.00                        # P term for control based on distance from line
-positionI = 0.00                        # I term for control based on distance from line
-positionD = 0.40                        # D term for control based on distance from line
+positionI = 0.00                        # I term per second for control based on distance from line
+positionD = 0.40 / 30                   # D term in seconds for control based on distance from line
 changeP = 1.00                          # P term for control based on change between the points from the line
-changeI = 0.00                          # I term for control based on change between the points from the line
-changeD = 0.40                          # D term for control based on change between the points from the line
+changeI = 0.00                          # I term per second for control based on change between the points from the line
+changeD = 0.40 / 30                     # D term in seconds for control based on change between the points from the line
 clipI = 100                             # Maximum limit for both integrators
+maxControlInterval = 0.25               # Longest gap in seconds between readings for the D terms to be used, also limits each I step
+minControlInterval = 0.5 / frameRate    # Shortest gap in seconds used for the I and D terms, stops frames arriving close together making the D terms jump
 
 # Final drive settings
 steeringGain = 1.0                      # Steering range correction value
@@ -44,6 +72,8 @@ steeringOffset = 0.0                    # Steering centre correction value
 fpsInterval = frameRate                 # Number of frames to average FPS over
 showFps = True                          # True to display FPS readings in the terminal
 testMode = True                         # True to prevent the robot moving, False will self-drive
+fastStart = True                        # True to start as soon as the camera and threads are ready, False to wait for the LED blinks and 2 seconds first
+startupTimeout = 10.0                   # Longest time in seconds to wait for the camera and threads to be ready
 showImages = True                       # True to show processing images
 overlayOriginal = True                  # True to draw over original image, False to show a mask instead
 showPerSecond = 1                       # Frames to show per second, lower has less impact on the running code
@@ -51,6 +81,11 @@ scaleFinalImage = 1.0                   # Use to resize the displayed image, 1.0
 targetLine = (0, 255, 255)              # Colour for the line between target points
 targetPoints = (255, 255, 0)            # Colour for the circles around each target point
 targetPointSize = 3                     # Size of the target circle around each target point
+streamImages = False                    # True to serve the processing images as an MJPEG stream over HTTP, no screen is needed
+streamAddress = ''                      # Network address to serve the stream on, '' for all, '127.0.0.1' for this Raspberry Pi only
+streamPort = 8080                       # Port to serve the stream on, view it at http://<Raspberry Pi address>:8080/
+streamPerSecond = 5                     # Frames to stream per second, nothing is encoded while nobody is watching
+streamQuality = 80                      # JPEG quality for the stream, 0 to 100
 
 #################
 # Shared values #
@@ -65,13 +100,14 @@ testModeCounter = 0                     # Tick in test mode for showing motor ou
 MonsterMotors = None                    # Function which runs the MonsterBorg motors
 
 # Shared data
-displayFrame = None                     # Image to show when running (if any)
-frameCounter = 0                        # Shared index for each frame coming in
-frameAnnounce = 0                       # Wrapping counter for FPS display
-lastFrameStamp = 0                      # Time stamp used for measuring FPS
+displayData = None                      # Latest processing results to draw the image to show from (if any)
+streamViewers = 0                       # Number of viewers watching the image stream, only changed by the stream encoder
+frameCounter = 0                        # Sequence number for the next frame coming in, only changed by the capture thread
 
 # Shared objects
-frameLock = None                        # Used to prevent threading clashes
-processorPool = None                    # List of available image processing threads
-capture = None                          # OpenCV image capture object
+processorPool = None                    # Pool of available image processing threads
+framePool = None                        # Preallocated frame buffers shared by the capture and processing threads
+capture = None                          # Frame source object, see FrameSource.py
 controller = None                       # Motor control thread
+motorDispatcher = None                  # Motor output thread
+pipelineStats = None                    # Latency and dropped frame statistics, see PipelineStats.py
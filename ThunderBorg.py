@@ -27,13 +27,20 @@ See the website at www.piborg.org/thunderborg for more details
 """
 
 # Import the libraries we need
+import os
 import io
 import fcntl
+import ctypes
 import types
 import time
+import threading
 
 # Constant values
 I2C_SLAVE                   = 0x0703
+I2C_FUNCS                   = 0x0705
+I2C_RDWR                    = 0x0707
+I2C_FUNC_I2C                = 0x0001 # Bus supports combined I2C_RDWR transfers
+I2C_M_RD                    = 0x0001 # I2C_RDWR message is a read
 PWM_MAX                     = 255
 I2C_MAX_LEN                 = 6
 VOLTAGE_PIN_MAX             = 36.3  # Maximum voltage from the analog voltage monitoring pin
@@ -78,6 +85,97 @@ COMMAND_VALUE_OFF           = 0     # I2C value representing off
 
 COMMAND_ANALOG_MAX          = 0x3FF # Maximum value for analog readings
 
+MOTOR_KEEP_ALIVE            = 0.1   # Longest time between motor writes from SetBothMotors, well inside the 0.25 s communications failsafe
+EXTERNAL_LED_CHUNK          = 4     # External LED words sent in each transfer by WriteExternalLedPackets, motor writes can go in between
+EXTERNAL_LED_PACKET         = 5     # Size of each external LED packet, the command and one 32bit word
+
+# File remembering where the ThunderBorg boards were found, used by FindThunderBorg
+DISCOVERY_CACHE = '~/.thunderborg'
+
+# Default rates to read each value at in times per second, used by StartTelemetry
+TELEMETRY_RATES = {'battery': 1.0, 'driveFault1': 2.0, 'driveFault2': 2.0,
+                   'motor1': 0.0, 'motor2': 0.0, 'led1': 0.0, 'led2': 0.0}
+
+# Prebuilt motor commands for each PWM level, used by SetBothMotors
+MOTOR_PACKETS = dict([(command, [chr(command) + chr(pwm) for pwm in range(PWM_MAX + 1)])
+                      for command in (COMMAND_SET_A_FWD, COMMAND_SET_A_REV, COMMAND_SET_B_FWD,
+                                      COMMAND_SET_B_REV, COMMAND_SET_ALL_FWD, COMMAND_SET_ALL_REV)])
+
+
+def OpenBus(busNumber, address):
+    """
+i2cRead, i2cWrite = OpenBus(busNumber, address)
+
+Opens the IC bus for talking to the device at address, returns the file objects used for reading and writing
+All of the ThunderBorg functions open the bus using this function,
+it may be replaced to talk to something else, such as the simulated board in ThunderBorgSim.py
+    """
+    i2cRead = io.open("/dev/i2c-" + str(busNumber), "rb", buffering = 0)
+    fcntl.ioctl(i2cRead, I2C_SLAVE, address)
+    i2cWrite = io.open("/dev/i2c-" + str(busNumber), "wb", buffering = 0)
+    fcntl.ioctl(i2cWrite, I2C_SLAVE, address)
+    return i2cRead, i2cWrite
+
+
+def OpenTransfer(i2cRead, i2cWrite, address):
+    """
+transfer = OpenTransfer(i2cRead, i2cWrite, address)
+
+Makes the object used to send combined transfers, it has two functions:
+reply = transfer.WriteRead(command, length)   sends a command and reads back the reply as a new list, used by RawRead
+transfer.WriteMany(packets, packetSize)       sends a string of several packets of packetSize bytes each
+Where the bus supports it each call is sent as a single combined IC transfer,
+otherwise the packets are written and the reply read separately
+Bus objects from a replaced OpenBus may provide their own WriteRead and WriteMany functions
+    """
+    if hasattr(i2cRead, 'WriteRead'):
+        return i2cRead
+    functions = ctypes.c_ulong()
+    try:
+        fcntl.ioctl(i2cRead, I2C_FUNCS, functions)
+    except IOError:
+        functions.value = 0
+    if functions.value & I2C_FUNC_I2C:
+        return CombinedTransfer(i2cRead, address)
+    else:
+        return SeparateTransfer(i2cRead, i2cWrite)
+
+
+busLocks = {}
+busLocksLock = threading.Lock()
+
+def BusLock(busNumber):
+    """
+lock = BusLock(busNumber)
+
+Gets the lock held for each IC transaction on a bus, shared by all boards on that bus
+    """
+    with busLocksLock:
+        if busNumber not in busLocks:
+            busLocks[busNumber] = threading.RLock()
+        return busLocks[busNumber]
+
+
+def ProbeThunderBorg(busNumber, address):
+    """
+ProbeThunderBorg(busNumber, address)
+
+Checks if there is a ThunderBorg at the address on the IC bus, returns True if there is
+Nothing is printed, use Init() to check and open a board for use
+    """
+    bus = ThunderBorg()
+    try:
+        bus.InitBusOnly(busNumber, address)
+        i2cRecv = bus.RawRead(COMMAND_GET_ID, I2C_MAX_LEN)
+        if len(i2cRecv) == I2C_MAX_LEN:
+            if i2cRecv[1] == I2C_ID_THUNDERBORG:
+                return True
+    except KeyboardInterrupt:
+        raise
+    except:
+        pass
+    return False
+
 
 def ScanForThunderBorg(busNumber = 1):
     """
@@ -88,23 +186,10 @@ The busNumber if supplied is which I
     """
     found = []
     print 'Scanning IC bus #%d' % (busNumber)
-    bus = ThunderBorg()
     for address in range(0x03, 0x78, 1):
-        try:
-            bus.InitBusOnly(busNumber, address)
-            i2cRecv = bus.RawRead(COMMAND_GET_ID, I2C_MAX_LEN)
-            if len(i2cRecv) == I2C_MAX_LEN:
-                if i2cRecv[1] == I2C_ID_THUNDERBORG:
-                    print 'Found ThunderBorg at %02X' % (address)
-                    found.append(address)
-                else:
-                    pass
-            else:
-                pass
-        except KeyboardInterrupt:
-            raise
-        except:
-            pass
+        if ProbeThunderBorg(busNumber, address):
+            print 'Found ThunderBorg at %02X' % (address)
+            found.append(address)
     if len(found) == 0:
         print 'No ThunderBorg boards found, is bus #%d correct (should be 0 for Rev 1, 1 for Rev 2)' % (busNumber)
     elif len(found) == 1:
@@ -114,6 +199,64 @@ The busNumber if supplied is which I
     return found
 
 
+def FindThunderBorg(buses = (1, 0), cacheFile = DISCOVERY_CACHE, expected = None):
+    """
+boards = FindThunderBorg([buses], [cacheFile], [expected])
+
+Finds the attached ThunderBorg boards, returning a list of (busNumber, address) pairs
+The boards found last time are remembered in cacheFile and checked first, so after a restart no scan is normally needed
+If there are none, or any of them do not answer, the expected (busNumber, address) pairs are checked next
+If none of those answer every address on each of the buses is scanned, with all of the buses scanned at the same time
+buses is the IC bus numbers to scan, if not supplied both 1 (Rev 2 boards) and 0 (Rev 1 boards) are scanned
+expected if not supplied is the default address of 0x15 on each of the buses, the first one answering is used without a scan
+Pass None as cacheFile to not remember the boards, or delete the file to look again for newly attached boards
+e.g.
+FindThunderBorg()  -> [(1, 0x15)]
+    """
+    if cacheFile:
+        cacheFile = os.path.expanduser(cacheFile)
+        # Check the boards from last time
+        boards = []
+        try:
+            with open(cacheFile, 'r') as cache:
+                for line in cache:
+                    busNumber, address = line.split()
+                    boards.append((int(busNumber), int(address, 0)))
+        except (IOError, ValueError):
+            boards = []
+        if boards and all([ProbeThunderBorg(busNumber, address) for busNumber, address in boards]):
+            return boards
+    # Check where the board is expected to be before scanning
+    if expected is None:
+        expected = [(busNumber, I2C_ID_THUNDERBORG) for busNumber in buses]
+    boards = []
+    for busNumber, address in expected:
+        if ProbeThunderBorg(busNumber, address):
+            boards = [(busNumber, address)]
+            break
+    if not boards:
+        # Scan each bus in its own thread
+        found = dict([(busNumber, []) for busNumber in buses])
+        def ScanBus(busNumber):
+            for address in range(0x03, 0x78, 1):
+                if ProbeThunderBorg(busNumber, address):
+                    found[busNumber].append(address)
+        scans = [threading.Thread(target = ScanBus, args = (busNumber,)) for busNumber in buses]
+        for scan in scans:
+            scan.start()
+        for scan in scans:
+            scan.join()
+        boards = [(busNumber, address) for busNumber in buses for address in found[busNumber]]
+    if cacheFile and boards:
+        try:
+            with open(cacheFile, 'w') as cache:
+                for busNumber, address in boards:
+                    cache.write('%d 0x%02X\n' % (busNumber, address))
+        except IOError:
+            pass
+    return boards
+
+
 def SetNewAddress(newAddress, oldAddress = -1, busNumber = 1):
     """
 SetNewAddress(newAddress, [oldAddress], [busNumber])
@@ -203,6 +346,13 @@ printFunction           Function reference to call when printing text, if None "
     printFunction           = None
     i2cWrite                = None
     i2cRead                 = None
+    lastMotorPackets        = (None, None)          # Motor 1 and motor 2 commands last sent by SetBothMotors
+    lastMotorWrite          = 0.0                   # Time of the last write by SetBothMotors
+    motorWritesSkipped      = 0                     # Number of times SetBothMotors had nothing new to send
+    busLock                 = BusLock(busNumber)    # Held for each IC transaction, shared by all boards on the bus
+    motorWritePending       = False                 # True while SetBothMotors is waiting for the bus
+    telemetry               = None                  # Background telemetry thread, see StartTelemetry
+    faultCallbacks          = []                    # Functions called when a drive fault is seen, see AddFaultCallback
 
 
     def RawWrite(self, command, data):
@@ -214,10 +364,22 @@ Command codes can be found at the top of ThunderBorg.py, data is a list of 0 or
 
 Under most circumstances you should use the appropriate function instead of RawWrite
         """
-        rawOutput = chr(command)
-        for singleByte in data:
-            rawOutput += chr(singleByte)
-        self.i2cWrite.write(rawOutput)
+        rawOutput = chr(command) + ''.join([chr(singleByte) for singleByte in data])
+        with self.busLock:
+            self.i2cWrite.write(rawOutput)
+
+
+    def RawWritePacket(self, packet):
+        """
+RawWritePacket(packet)
+
+Sends a prebuilt command on the I2C bus to the ThunderBorg
+The packet is a string of the command code followed by the data bytes
+
+Under most circumstances you should use the appropriate function instead of RawWritePacket
+        """
+        with self.busLock:
+            self.i2cWrite.write(packet)
 
 
     def RawRead(self, command, length, retryCount = 3):
@@ -227,17 +389,15 @@ RawRead(command, length, [retryCount])
 Reads data back from the ThunderBorg after sending a GET command
 Command codes can be found at the top of ThunderBorg.py, length is the number of bytes to read back
 
+The command is sent and the reply read back in a single combined transfer where the I2C bus supports it
 The function checks that the first byte read back matches the requested command
 If it does not it will retry the request until retryCount is exhausted (default is 3 times)
 
 Under most circumstances you should use the appropriate function instead of RawRead
         """
         while retryCount > 0:
-            self.RawWrite(command, [])
-            rawReply = self.i2cRead.read(length)
-            reply = []
-            for singleByte in rawReply:
-                reply.append(ord(singleByte))
+            with self.busLock:
+                reply = self.i2cTransfer.WriteRead(command, length)
             if command == reply[0]:
                 break
             else:
@@ -257,10 +417,9 @@ This call does not check the board is present or working, under most circumstanc
         """
         self.busNumber = busNumber
         self.i2cAddress = address
-        self.i2cRead = io.open("/dev/i2c-" + str(self.busNumber), "rb", buffering = 0)
-        fcntl.ioctl(self.i2cRead, I2C_SLAVE, self.i2cAddress)
-        self.i2cWrite = io.open("/dev/i2c-" + str(self.busNumber), "wb", buffering = 0)
-        fcntl.ioctl(self.i2cWrite, I2C_SLAVE, self.i2cAddress)
+        self.busLock = BusLock(self.busNumber)
+        self.i2cRead, self.i2cWrite = OpenBus(self.busNumber, self.i2cAddress)
+        self.i2cTransfer = OpenTransfer(self.i2cRead, self.i2cWrite, self.i2cAddress)
 
 
     def Print(self, message):
@@ -298,10 +457,9 @@ If tryOtherBus is True, this function will attempt to use the other bus if the T
         self.Print('Loading ThunderBorg on bus %d, address %02X' % (self.busNumber, self.i2cAddress))
 
         # Open the bus
-        self.i2cRead = io.open("/dev/i2c-" + str(self.busNumber), "rb", buffering = 0)
-        fcntl.ioctl(self.i2cRead, I2C_SLAVE, self.i2cAddress)
-        self.i2cWrite = io.open("/dev/i2c-" + str(self.busNumber), "wb", buffering = 0)
-        fcntl.ioctl(self.i2cWrite, I2C_SLAVE, self.i2cAddress)
+        self.busLock = BusLock(self.busNumber)
+        self.i2cRead, self.i2cWrite = OpenBus(self.busNumber, self.i2cAddress)
+        self.i2cTransfer = OpenTransfer(self.i2cRead, self.i2cWrite, self.i2cAddress)
 
         # Check for ThunderBorg
         try:
@@ -364,7 +522,9 @@ SetMotor2(1)     -> motor 2 moving forward at 100% power
                 pwm = PWM_MAX
 
         try:
-            self.RawWrite(command, [pwm])
+            with self.busLock:
+                self.lastMotorPackets = (None, None)
+                self.RawWrite(command, [pwm])
         except KeyboardInterrupt:
             raise
         except:
@@ -425,7 +585,9 @@ SetMotor1(1)     -> motor 1 moving forward at 100% power
                 pwm = PWM_MAX
 
         try:
-            self.RawWrite(command, [pwm])
+            with self.busLock:
+                self.lastMotorPackets = (None, None)
+                self.RawWrite(command, [pwm])
         except KeyboardInterrupt:
             raise
         except:
@@ -486,13 +648,86 @@ SetMotors(1)     -> all motors are moving forward at 100% power
                 pwm = PWM_MAX
 
         try:
-            self.RawWrite(command, [pwm])
+            with self.busLock:
+                self.lastMotorPackets = (None, None)
+                self.RawWrite(command, [pwm])
         except KeyboardInterrupt:
             raise
         except:
             self.Print('Failed sending all motors drive level!')
 
 
+    def SetBothMotors(self, power1, power2):
+        """
+SetBothMotors(power1, power2)
+
+Sets the drive levels for motor 1 and motor 2 together, from +1 to -1.
+As few IC writes as possible are used:
+    Levels which have not changed since the last call are not sent again
+    When both motors change to the same level a single command sets them both
+    Unchanged levels are sent again if MOTOR_KEEP_ALIVE seconds have passed since the last write,
+    call at least that often to keep the communications failsafe from stopping the motors
+e.g.
+SetBothMotors(0, 0)       -> both motors are stopped
+SetBothMotors(0.75, 0.5)  -> motor 1 moving forward at 75% power, motor 2 moving forward at 50% power
+SetBothMotors(-0.5, 0.5)  -> motor 1 moving reverse at 50% power, motor 2 moving forward at 50% power
+SetBothMotors(1, 1)       -> both motors moving forward at 100% power
+        """
+        if power1 < 0:
+            # Reverse
+            command1 = COMMAND_SET_A_REV
+            pwm1 = min(-int(PWM_MAX * power1), PWM_MAX)
+        else:
+            # Forward / stopped
+            command1 = COMMAND_SET_A_FWD
+            pwm1 = min(int(PWM_MAX * power1), PWM_MAX)
+        if power2 < 0:
+            # Reverse
+            command2 = COMMAND_SET_B_REV
+            pwm2 = min(-int(PWM_MAX * power2), PWM_MAX)
+        else:
+            # Forward / stopped
+            command2 = COMMAND_SET_B_FWD
+            pwm2 = min(int(PWM_MAX * power2), PWM_MAX)
+        packet1 = MOTOR_PACKETS[command1][pwm1]
+        packet2 = MOTOR_PACKETS[command2][pwm2]
+
+        # Let the telemetry thread know to leave the bus to us
+        self.motorWritePending = True
+        with self.busLock:
+            self.motorWritePending = False
+            # Work out what needs sending, everything if the keep alive is due
+            # The last levels are checked and updated while holding the bus so callers from other threads cannot interleave
+            now = time.time()
+            last1, last2 = self.lastMotorPackets
+            if (now - self.lastMotorWrite) >= MOTOR_KEEP_ALIVE:
+                last1 = None
+                last2 = None
+            elif (packet1 == last1) and (packet2 == last2):
+                self.motorWritesSkipped += 1
+                return
+            try:
+                if (packet1 != last1) and (packet2 != last2) and (pwm1 == pwm2) and ((command1 == COMMAND_SET_A_REV) == (command2 == COMMAND_SET_B_REV)):
+                    # Both motors are changing to the same level
+                    if command1 == COMMAND_SET_A_REV:
+                        self.RawWritePacket(MOTOR_PACKETS[COMMAND_SET_ALL_REV][pwm1])
+                    else:
+                        self.RawWritePacket(MOTOR_PACKETS[COMMAND_SET_ALL_FWD][pwm1])
+                else:
+                    if packet1 != last1:
+                        self.RawWritePacket(packet1)
+                    if packet2 != last2:
+                        self.RawWritePacket(packet2)
+                self.lastMotorPackets = (packet1, packet2)
+                self.lastMotorWrite = now
+            except KeyboardInterrupt:
+                raise
+            except:
+                # Send both levels again next time
+                self.lastMotorPackets = (None, None)
+                self.Print('Failed sending motor drive levels!')
+
+
     def MotorsOff(self):
         """
 MotorsOff()
@@ -500,7 +735,9 @@ MotorsOff()
 Sets all motors to stopped, useful when ending a program
         """
         try:
-            self.RawWrite(COMMAND_ALL_OFF, [0])
+            with self.busLock:
+                self.lastMotorPackets = (None, None)
+                self.RawWrite(COMMAND_ALL_OFF, [0])
         except KeyboardInterrupt:
             raise
         except:
@@ -884,12 +1121,104 @@ will set a single LED to full yellow.
 SetExternalLedColours([[1.0, 0.0, 0.0], [0.5, 0.0, 0.0], [0.0, 0.0, 0.0]])
 will set LED 1 to full red, LED 2 to half red, and LED 3 to off.
         """
-        # Send the start marker
-        self.WriteExternalLedWord(0, 0, 0, 0)
-
-        # Send each colour in turn
+        # Build the start marker and each colour as packets, then send them together
+        packets = [chr(COMMAND_WRITE_EXTERNAL_LED) + '\x00\x00\x00\x00']
         for r, g, b in colours:
-            self.WriteExternalLedWord(255, 255 * b, 255 * g, 255 * r)
+            levels = [max(0, min(PWM_MAX, int(255 * level))) for level in (b, g, r)]
+            packets.append(chr(COMMAND_WRITE_EXTERNAL_LED) + chr(PWM_MAX) + ''.join([chr(level) for level in levels]))
+        self.WriteExternalLedPackets(''.join(packets))
+
+
+    def WriteExternalLedPackets(self, packets):
+        """
+WriteExternalLedPackets(packets)
+
+Sends a prebuilt set of external LED words, the fastest way of setting all of the LEDs
+packets is a string of 5 byte packets, each is COMMAND_WRITE_EXTERNAL_LED followed by the 4 bytes of one word,
+the first packet should be the all zero start marker
+The packets are sent EXTERNAL_LED_CHUNK at a time, each group as a single IC transfer where the bus supports it
+Any SetBothMotors calls waiting for the bus go in between the groups, so long LED strips do not hold up the motors
+LedAnimation.py can build the packets from a numpy array of colours
+        """
+        chunkSize = EXTERNAL_LED_CHUNK * EXTERNAL_LED_PACKET
+        try:
+            for start in range(0, len(packets), chunkSize):
+                while self.motorWritePending:
+                    time.sleep(0.0005)
+                with self.busLock:
+                    self.i2cTransfer.WriteMany(packets[start : start + chunkSize], EXTERNAL_LED_PACKET)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.Print('Failed sending the external LED colours!')
+
+
+    def StartTelemetry(self, rates = None):
+        """
+StartTelemetry([rates])
+
+Starts reading values from the ThunderBorg in a background thread
+The latest readings can then be had from GetTelemetry straight away, without waiting for the IC bus
+rates is a dictionary of how many times per second to read each value, any not given use the rate from TELEMETRY_RATES:
+    'battery'       GetBatteryReading
+    'driveFault1'   GetDriveFault1
+    'driveFault2'   GetDriveFault2
+    'motor1'        GetMotor1
+    'motor2'        GetMotor2
+    'led1'          GetLed1
+    'led2'          GetLed2
+A rate of 0 means that value is not read
+Reads wait for any waiting SetBothMotors calls to finish first so they do not hold up the motors
+e.g.
+StartTelemetry()                  -> read the battery and drive faults at the default rates
+StartTelemetry({'battery': 0.2})  -> read the battery every 5 seconds instead
+        """
+        self.StopTelemetry()
+        pollRates = dict(TELEMETRY_RATES)
+        if rates:
+            pollRates.update(rates)
+        self.telemetry = TelemetryPoller(self, pollRates)
+        self.telemetry.start()
+
+
+    def StopTelemetry(self):
+        """
+StopTelemetry()
+
+Stops the background thread started by StartTelemetry, the last readings are still available from GetTelemetry
+        """
+        if self.telemetry:
+            self.telemetry.terminated = True
+            self.telemetry.wake.set()
+            self.telemetry.join()
+
+
+    def GetTelemetry(self, name):
+        """
+value, timestamp = GetTelemetry(name)
+
+Gets the latest reading made by the telemetry thread, see StartTelemetry for the names
+The timestamp is the time.time() when the reading was made
+If there has not been a successful reading yet both are None
+e.g.
+GetTelemetry('battery')      -> (11.9, 1500000000.0)
+GetTelemetry('driveFault1')  -> (False, 1500000000.0)
+        """
+        if self.telemetry:
+            return self.telemetry.readings.get(name, (None, None))
+        else:
+            return None, None
+
+
+    def AddFaultCallback(self, callback):
+        """
+AddFaultCallback(callback)
+
+Adds a function to be called by the telemetry thread when a drive fault is seen
+The function is called as callback(name, value), where name is 'driveFault1' or 'driveFault2' and value is True
+It is called once each time the fault appears, and should return quickly
+        """
+        self.faultCallbacks = self.faultCallbacks + [callback]
 
 
     def Help(self):
@@ -906,3 +1235,133 @@ Displays the names and descriptions of the various functions and settings provid
         for func in funcListSorted:
             print '=== %s === %s' % (func.func_name, func.func_doc)
 
+
+# Background thread which keeps the readings used by GetTelemetry up to date
+class TelemetryPoller(threading.Thread):
+    def __init__(self, board, rates):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.board = board
+        self.terminated = False
+        self.wake = threading.Event()
+        self.readings = {}
+        getters = {'battery': board.GetBatteryReading, 'driveFault1': board.GetDriveFault1,
+                   'driveFault2': board.GetDriveFault2, 'motor1': board.GetMotor1, 'motor2': board.GetMotor2,
+                   'led1': board.GetLed1, 'led2': board.GetLed2}
+        self.polls = [(name, getters[name], 1.0 / rate) for name, rate in rates.items() if rate > 0]
+
+    def run(self):
+        nextRead = dict([(name, time.time()) for name, getter, interval in self.polls])
+        while not self.terminated and self.polls:
+            # Sleep until the next reading is due
+            name, getter, interval = min(self.polls, key = lambda poll: nextRead[poll[0]])
+            delay = nextRead[name] - time.time()
+            if delay > 0:
+                self.wake.wait(delay)
+                continue
+            # Motor writes waiting for the bus go first
+            while self.board.motorWritePending and not self.terminated:
+                time.sleep(0.001)
+            value = getter()
+            now = time.time()
+            nextRead[name] = max(nextRead[name] + interval, now)
+            if value is None:
+                # Failed reading, keep the last good value
+                continue
+            if name.startswith('driveFault') and value:
+                lastValue, lastTime = self.readings.get(name, (False, None))
+                if not lastValue:
+                    for callback in self.board.faultCallbacks:
+                        callback(name, value)
+            self.readings[name] = (value, now)
+
+
+# Message and request structures for the I2C_RDWR ioctl, see linux/i2c-dev.h
+class I2cMessage(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16), ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16), ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class I2cRdwrRequest(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(I2cMessage)), ('nmsgs', ctypes.c_uint32)]
+
+
+# Command write and reply read sent as one I2C_RDWR ioctl, with a repeated start in between
+# Groups of packets are written the same way, as one message each in a single ioctl
+# The messages and buffers are built once for each length and reused for every transfer
+class CombinedTransfer(object):
+    def __init__(self, i2cFile, address):
+        self.i2cFile = i2cFile
+        self.address = address
+        self.commandBuffer = (ctypes.c_uint8 * 1)()
+        self.requests = {}
+        self.writeRequests = {}
+
+    def MakeRequest(self, length):
+        replyBuffer = (ctypes.c_uint8 * length)()
+        messages = (I2cMessage * 2)()
+        messages[0].addr = self.address
+        messages[0].flags = 0
+        messages[0].len = 1
+        messages[0].buf = ctypes.cast(self.commandBuffer, ctypes.POINTER(ctypes.c_uint8))
+        messages[1].addr = self.address
+        messages[1].flags = I2C_M_RD
+        messages[1].len = length
+        messages[1].buf = ctypes.cast(replyBuffer, ctypes.POINTER(ctypes.c_uint8))
+        request = I2cRdwrRequest(ctypes.cast(messages, ctypes.POINTER(I2cMessage)), 2)
+        # Keep the buffers alive for as long as the request
+        self.requests[length] = (request, messages, replyBuffer)
+        return self.requests[length]
+
+    def WriteRead(self, command, length):
+        if length in self.requests:
+            request, messages, replyBuffer = self.requests[length]
+        else:
+            request, messages, replyBuffer = self.MakeRequest(length)
+        self.commandBuffer[0] = command
+        fcntl.ioctl(self.i2cFile, I2C_RDWR, request)
+        # The copy is deliberate, the reply is checked and handed back by RawRead after the bus lock is released,
+        # by which time another thread may be reading into the same buffer
+        return replyBuffer[:]
+
+    def MakeWriteRequest(self, count, packetSize):
+        packetBuffer = (ctypes.c_uint8 * (count * packetSize))()
+        messages = (I2cMessage * count)()
+        for i in range(count):
+            messages[i].addr = self.address
+            messages[i].flags = 0
+            messages[i].len = packetSize
+            messages[i].buf = ctypes.cast(ctypes.addressof(packetBuffer) + i * packetSize, ctypes.POINTER(ctypes.c_uint8))
+        request = I2cRdwrRequest(ctypes.cast(messages, ctypes.POINTER(I2cMessage)), count)
+        self.writeRequests[count, packetSize] = (request, messages, packetBuffer)
+        return self.writeRequests[count, packetSize]
+
+    def WriteMany(self, packets, packetSize):
+        count = len(packets) // packetSize
+        if (count, packetSize) in self.writeRequests:
+            request, messages, packetBuffer = self.writeRequests[count, packetSize]
+        else:
+            request, messages, packetBuffer = self.MakeWriteRequest(count, packetSize)
+        ctypes.memmove(packetBuffer, packets, count * packetSize)
+        fcntl.ioctl(self.i2cFile, I2C_RDWR, request)
+
+
+# Separate writes and reads, for buses without I2C_RDWR support
+class SeparateTransfer(object):
+    def __init__(self, i2cRead, i2cWrite):
+        self.i2cRead = i2cRead
+        self.i2cWrite = i2cWrite
+        self.replyBuffers = {}
+
+    def WriteRead(self, command, length):
+        if length not in self.replyBuffers:
+            self.replyBuffers[length] = bytearray(length)
+        replyBuffer = self.replyBuffers[length]
+        self.i2cWrite.write(chr(command))
+        count = self.i2cRead.readinto(replyBuffer)
+        # Copied for the same reason as CombinedTransfer.WriteRead
+        return list(replyBuffer[:count])
+
+    def WriteMany(self, packets, packetSize):
+        for start in range(0, len(packets), packetSize):
+            self.i2cWrite.write(packets[start : start + packetSize])
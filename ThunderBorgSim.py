@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding: Latin-1
+
+# Load library functions we want
+import errno
+import random
+import threading
+import time
+import ThunderBorg
+
+# Simulated ThunderBorg which answers the same commands as the real board, so the ThunderBorg
+# driver and the motor code can be run and timed without the board, e.g.
+#   board = ThunderBorgSim.Install()
+#   TB = ThunderBorg.ThunderBorg()
+#   TB.Init()
+# Every read and write waits for the time it would take on the IC bus, including the combined
+# transfers used by ThunderBorg.RawRead and WriteExternalLedPackets, and errors can be injected:
+#   readErrorRate   chance of a read returning the wrong reply, RawRead will retry
+#   writeErrorRate  chance of a write failing with an IOError, as if the board did not answer
+# Missing boards (wrong bus or address) fail every read and write in the same way the real bus does
+
+defaultByteTime = 9.0 / 100000         # Each byte plus its acknowledge at the standard 100 kHz bus speed
+failsafeTime = 0.25                    # Time without motor commands before the failsafe stops the motors
+
+
+# Simulated board, holds the state the real board keeps in its registers
+class SimulatedThunderBorg(object):
+    def __init__(self, busNumber = 1, address = ThunderBorg.I2C_ID_THUNDERBORG):
+        self.busNumber = busNumber
+        self.address = address
+        self.lock = threading.Lock()
+        # Bus timing and error injection
+        self.byteTime = defaultByteTime
+        self.transactionTime = 0.0
+        self.readErrorRate = 0.0
+        self.writeErrorRate = 0.0
+        # Board state, may be changed to simulate the board
+        self.batteryVoltage = 12.0
+        self.driveFault1 = False
+        self.driveFault2 = False
+        self.motor1 = (ThunderBorg.COMMAND_VALUE_FWD, 0)
+        self.motor2 = (ThunderBorg.COMMAND_VALUE_FWD, 0)
+        self.led1 = (0, 0, 0)
+        self.led2 = (0, 0, 0)
+        self.ledShowBattery = True
+        self.failsafe = False
+        self.lastMotorCommand = time.time()
+        self.batteryLimits = (int(ThunderBorg.BATTERY_MIN_DEFAULT / ThunderBorg.VOLTAGE_PIN_MAX * 0xFF),
+                              int(ThunderBorg.BATTERY_MAX_DEFAULT / ThunderBorg.VOLTAGE_PIN_MAX * 0xFF))
+        self.externalLedWords = []
+        self.reply = []
+        # Counts of the bus traffic
+        self.writes = 0
+        self.reads = 0
+        self.errorsInjected = 0
+        self.busTime = 0.0
+
+    # Used in place of ThunderBorg.OpenBus, see Install
+    def OpenBus(self, busNumber, address):
+        handle = SimulatedBus(self, busNumber, address)
+        return handle, handle
+
+    # Wait for a transfer of byteCount bytes to finish, including the address byte
+    def Transfer(self, byteCount):
+        delay = self.transactionTime + (byteCount + 1) * self.byteTime
+        self.busTime += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def Present(self, busNumber, address):
+        return (busNumber == self.busNumber) and (address == self.address)
+
+    # Stop the motors if the failsafe is on and they have not been set recently
+    def CheckFailsafe(self):
+        if self.failsafe and (time.time() - self.lastMotorCommand) > failsafeTime:
+            self.motor1 = (ThunderBorg.COMMAND_VALUE_FWD, 0)
+            self.motor2 = (ThunderBorg.COMMAND_VALUE_FWD, 0)
+
+    # Carry out a command written to the board, GET commands prepare the reply for the next read
+    def Command(self, command, data):
+        self.CheckFailsafe()
+        if command == ThunderBorg.COMMAND_GET_ID:
+            self.reply = [command, ThunderBorg.I2C_ID_THUNDERBORG]
+        elif command == ThunderBorg.COMMAND_SET_LED1:
+            self.led1 = tuple(data[:3])
+        elif command == ThunderBorg.COMMAND_GET_LED1:
+            self.reply = [command] + list(self.led1)
+        elif command == ThunderBorg.COMMAND_SET_LED2:
+            self.led2 = tuple(data[:3])
+        elif command == ThunderBorg.COMMAND_GET_LED2:
+            self.reply = [command] + list(self.led2)
+        elif command == ThunderBorg.COMMAND_SET_LEDS:
+            self.led1 = tuple(data[:3])
+            self.led2 = tuple(data[:3])
+        elif command == ThunderBorg.COMMAND_SET_LED_BATT_MON:
+            self.ledShowBattery = (data[0] != ThunderBorg.COMMAND_VALUE_OFF)
+        elif command == ThunderBorg.COMMAND_GET_LED_BATT_MON:
+            self.reply = [command, self.OnOff(self.ledShowBattery)]
+        elif command in (ThunderBorg.COMMAND_SET_A_FWD, ThunderBorg.COMMAND_SET_A_REV,
+                         ThunderBorg.COMMAND_SET_B_FWD, ThunderBorg.COMMAND_SET_B_REV,
+                         ThunderBorg.COMMAND_SET_ALL_FWD, ThunderBorg.COMMAND_SET_ALL_REV):
+            if command in (ThunderBorg.COMMAND_SET_A_REV, ThunderBorg.COMMAND_SET_B_REV, ThunderBorg.COMMAND_SET_ALL_REV):
+                motor = (ThunderBorg.COMMAND_VALUE_REV, data[0])
+            else:
+                motor = (ThunderBorg.COMMAND_VALUE_FWD, data[0])
+            if command not in (ThunderBorg.COMMAND_SET_B_FWD, ThunderBorg.COMMAND_SET_B_REV):
+                self.motor1 = motor
+            if command not in (ThunderBorg.COMMAND_SET_A_FWD, ThunderBorg.COMMAND_SET_A_REV):
+                self.motor2 = motor
+            self.lastMotorCommand = time.time()
+        elif command == ThunderBorg.COMMAND_GET_A:
+            self.reply = [command] + list(self.motor1)
+        elif command == ThunderBorg.COMMAND_GET_B:
+            self.reply = [command] + list(self.motor2)
+        elif command == ThunderBorg.COMMAND_ALL_OFF:
+            self.motor1 = (ThunderBorg.COMMAND_VALUE_FWD, 0)
+            self.motor2 = (ThunderBorg.COMMAND_VALUE_FWD, 0)
+            self.lastMotorCommand = time.time()
+        elif command == ThunderBorg.COMMAND_GET_DRIVE_A_FAULT:
+            self.reply = [command, self.OnOff(self.driveFault1)]
+        elif command == ThunderBorg.COMMAND_GET_DRIVE_B_FAULT:
+            self.reply = [command, self.OnOff(self.driveFault2)]
+        elif command == ThunderBorg.COMMAND_SET_FAILSAFE:
+            self.failsafe = (data[0] != ThunderBorg.COMMAND_VALUE_OFF)
+            self.lastMotorCommand = time.time()
+        elif command == ThunderBorg.COMMAND_GET_FAILSAFE:
+            self.reply = [command, self.OnOff(self.failsafe)]
+        elif command == ThunderBorg.COMMAND_GET_BATT_VOLT:
+            raw = (self.batteryVoltage - ThunderBorg.VOLTAGE_PIN_CORRECTION) / ThunderBorg.VOLTAGE_PIN_MAX
+            raw = max(0, min(ThunderBorg.COMMAND_ANALOG_MAX, int(round(raw * ThunderBorg.COMMAND_ANALOG_MAX))))
+            self.reply = [command, raw >> 8, raw & 0xFF]
+        elif command == ThunderBorg.COMMAND_SET_BATT_LIMITS:
+            self.batteryLimits = tuple(data[:2])
+        elif command == ThunderBorg.COMMAND_GET_BATT_LIMITS:
+            self.reply = [command] + list(self.batteryLimits)
+        elif command == ThunderBorg.COMMAND_WRITE_EXTERNAL_LED:
+            self.externalLedWords.append(tuple(data[:4]))
+        elif command == ThunderBorg.COMMAND_SET_I2C_ADD:
+            self.address = data[0]
+        else:
+            # Unknown commands are ignored, the next read gets nothing useful back
+            self.reply = []
+
+    def OnOff(self, state):
+        if state:
+            return ThunderBorg.COMMAND_VALUE_ON
+        else:
+            return ThunderBorg.COMMAND_VALUE_OFF
+
+
+# Stands in for the read and write file objects of the IC bus
+class SimulatedBus(object):
+    def __init__(self, board, busNumber, address):
+        self.board = board
+        self.busNumber = busNumber
+        self.address = address
+
+    def Missing(self):
+        return IOError(errno.EREMOTEIO, 'Remote I/O error (simulated)')
+
+    def write(self, data):
+        board = self.board
+        with board.lock:
+            board.Transfer(len(data))
+            self.Write([ord(singleByte) for singleByte in data])
+        return len(data)
+
+    def read(self, length):
+        board = self.board
+        with board.lock:
+            board.Transfer(length)
+            reply = self.Read(length)
+        return ''.join([chr(value) for value in reply])
+
+    # Combined transfer used by ThunderBorg.RawRead, the address is sent again for the read but there is only one transaction
+    def WriteRead(self, command, length):
+        board = self.board
+        with board.lock:
+            board.Transfer(1 + 1 + length)
+            self.Write([command])
+            return self.Read(length)
+
+    # Several packets sent as one transaction, the address is sent again for each packet
+    def WriteMany(self, packets, packetSize):
+        board = self.board
+        with board.lock:
+            count = len(packets) // packetSize
+            board.Transfer(len(packets) + count - 1)
+            for start in range(0, len(packets), packetSize):
+                self.Write([ord(singleByte) for singleByte in packets[start : start + packetSize]])
+
+    def Write(self, values):
+        board = self.board
+        board.writes += 1
+        if not board.Present(self.busNumber, self.address):
+            raise self.Missing()
+        if random.random() < board.writeErrorRate:
+            board.errorsInjected += 1
+            raise self.Missing()
+        board.Command(values[0], values[1:])
+
+    def Read(self, length):
+        board = self.board
+        board.reads += 1
+        if not board.Present(self.busNumber, self.address):
+            raise self.Missing()
+        reply = (board.reply + [0] * length)[:length]
+        if random.random() < board.readErrorRate:
+            # Garbled reply, the command byte will not match
+            board.errorsInjected += 1
+            reply = [(reply[0] + 1) & 0xFF] + reply[1:]
+        return reply
+
+    def close(self):
+        pass
+
+
+# Make the ThunderBorg module talk to a simulated board from now on, returns the board
+def Install(board = None):
+    if board is None:
+        board = SimulatedThunderBorg()
+    ThunderBorg.OpenBus = board.OpenBus
+    return board